@@ -25,76 +25,499 @@ Derived and generalized from ECN Spider
 
 """
 
+import os
 import sys
 import time
 import logging
 import socket
+import errno
+import selectors
 import collections
 import threading
 import multiprocessing as mp
 import queue
+import asyncio
+import itertools
 
 from ipaddress import ip_address
 
+from pathspider.metrics import ConfiguratorMetrics
+from pathspider.metrics import MetricsExporter
+from pathspider.metrics import METRICS_JSONL
+from pathspider.observer import FLOW_MAX_HOLD
+
 ###
 ### Utility Classes
 ###
 
-class SemaphoreN(threading.BoundedSemaphore):
+class PhaseBarrier:
     """
-    An extension to the standard library's BoundedSemaphore that provides
-    functions to handle n tokens at once.
+    A cyclic barrier between the configurator and the workers, which takes
+    turns between two phases, one for each configuration.
+
+    Workers call :meth:`enter` to wait for a phase, and :meth:`leave` when
+    they are done with it. The configurator waits with
+    :meth:`wait_for_demand` until some worker wants a phase, sets the
+    configuration, and calls :meth:`open`. That admits the workers waiting
+    for the phase at that moment, and no others. It then waits with
+    :meth:`wait_for_users` until all of them have left, before calling
+    :meth:`close`.
+
+    The parties to each phase are counted when it is opened, so workers
+    which are idle, or which have shut down, do not hold it up. A worker
+    which gives up waiting, because of its timeout or because the barrier
+    was stopped, retires from the phase it would have been admitted to.
+    Each call takes the barrier lock a constant number of times, however
+    many workers there are. The workers waiting for each phase and the
+    configurator wait on separate conditions, so that a worker arriving only
+    wakes the configurator, and opening a phase only wakes the workers
+    waiting for it.
     """
-    def __init__(self, value):
-        self._value = value
-        super().__init__(self._value)
-        self.empty()
 
-    def __str__(self):
-        return 'SemaphoreN with a maximum value of {}.'.format(self._value)
+    # indices into the barrier state
+    _STATE = 0          # the open phase, or _CLOSED
+    _WAITING = 1        # and 2: workers waiting for each phase
+    _ADMITTED = 3       # admitted to the open phase but not yet entered
+    _USERS = 4          # entered the open phase and not yet left
+    _STOPPED = 5
+
+    _CLOSED = -1
+
+    def __init__(self):
+        lock = threading.Lock()
+        self._workers = [threading.Condition(lock), threading.Condition(lock)]
+        self._configurator = threading.Condition(lock)
+        self._state = [self._CLOSED, 0, 0, 0, 0, 0]
 
-    def acquire_n(self, value=1, blocking=True, timeout=None):
+    def share(self):
         """
-        Acquire ``value`` number of tokens at once.
+        Move the barrier state into shared memory, so that the barrier can be
+        used by processes forked afterwards.
+        """
+        lock = mp.Lock()
+        self._workers = [mp.Condition(lock), mp.Condition(lock)]
+        self._configurator = mp.Condition(lock)
+        self._state = mp.RawArray('i', self._state)
 
-        The parameters ``blocking`` and ``timeout`` have the same semantics as
-        :class:`BoundedSemaphore`.
+    def stop(self):
+        """
+        Stop the barrier, waking all waiting workers and the configurator.
+        """
+        with self._configurator:
+            self._state[self._STOPPED] = 1
+            for workers in self._workers:
+                workers.notify_all()
+            self._configurator.notify_all()
 
-        :returns: The same value as the last call to `BoundedSemaphore`'s
-        :meth:`acquire` if :meth:`acquire` were called ``value`` times instead
-        of the call to this method.
+    def enter(self, phase, timeout=None):
         """
-        ret = None
-        for _ in range(value):
-            ret = self.acquire(blocking=blocking, timeout=timeout)
-        return ret
+        Wait to be admitted to a phase, and enter it.
+
+        :param phase: The phase to wait for (0 or 1).
+        :type phase: int
+        :param timeout: The longest time in seconds to wait in total, or
+                        None to wait until admitted or stopped.
+        :type timeout: float
+        :returns: bool -- False if the wait timed out or the barrier was
+                  stopped.
+        """
+        state = self._state
+        deadline = None if timeout is None else time.monotonic() + timeout
+        workers = self._workers[phase]
+        with workers:
+            state[self._WAITING + phase] += 1
+            self._configurator.notify()
+
+            while not (state[self._STATE] == phase and
+                       state[self._ADMITTED] > 0):
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                if state[self._STOPPED] or (remaining is not None and
+                                            remaining <= 0):
+                    self._retire(phase)
+                    return False
+                workers.wait(remaining)
+
+            state[self._WAITING + phase] -= 1
+            state[self._ADMITTED] -= 1
+            state[self._USERS] += 1
+            return True
+
+    def _retire(self, phase):
+        # don't leave the open phase waiting for a worker which has gone
+        state = self._state
+        state[self._WAITING + phase] -= 1
+        if (state[self._STATE] == phase and
+                state[self._ADMITTED] > state[self._WAITING + phase]):
+            state[self._ADMITTED] = state[self._WAITING + phase]
+            self._configurator.notify()
+
+    def leave(self, phase):
+        """
+        Leave a phase entered with :meth:`enter`.
+        """
+        state = self._state
+        with self._configurator:
+            state[self._USERS] -= 1
+            if state[self._USERS] == 0 and state[self._ADMITTED] == 0:
+                self._configurator.notify()
 
-    def release_n(self, value=1):
+    def wait_for_demand(self, phase, timeout=None):
         """
-        Release ``value`` number of tokens at once.
+        Wait until a worker is waiting for a phase.
 
-        :returns: The same value as the last call to `BoundedSemaphore`'s
-        :meth:`release` if :meth:`release` were called ``value`` times instead
-        of the call to this method.
+        :param phase: The phase to prefer, if workers are waiting for both.
+        :type phase: int
+        :returns: int -- The phase to open next, or None if the wait timed
+                  out or the barrier was stopped.
         """
-        ret = None
-        for _ in range(value):
-            ret = self.release()
-        return ret
+        state = self._state
+        with self._configurator:
+            if not self._configurator.wait_for(
+                    lambda: (state[self._STOPPED] or state[self._WAITING] or
+                             state[self._WAITING + 1]), timeout):
+                return None
+            if state[self._STOPPED]:
+                return None
+            if state[self._WAITING + phase] == 0:
+                phase = 1 - phase
+            return phase
+
+    def open(self, phase):
+        """
+        Open a phase to the workers waiting for it.
 
-    def empty(self):
+        :returns: int -- The number of workers admitted.
         """
-        Acquire all tokens of the semaphore.
+        state = self._state
+        workers = self._workers[phase]
+        with workers:
+            state[self._STATE] = phase
+            state[self._ADMITTED] = state[self._WAITING + phase]
+            workers.notify_all()
+            return state[self._ADMITTED]
+
+    def wait_for_users(self, timeout=None):
         """
-        while self.acquire(blocking=False):
-            pass
+        Wait until all the workers admitted to the open phase have left it.
+
+        :returns: bool -- False if the wait timed out or the barrier was
+                  stopped.
+        """
+        state = self._state
+        with self._configurator:
+            return self._configurator.wait_for(
+                    lambda: (state[self._STOPPED] or
+                             (state[self._ADMITTED] == 0 and
+                              state[self._USERS] == 0)),
+                    timeout) and not state[self._STOPPED]
+
+    def close(self):
+        """
+        Close the open phase, before the configuration is changed.
+        """
+        with self._configurator:
+            self._state[self._STATE] = self._CLOSED
+
+class ExpiringTable:
+    """
+    A dictionary of records waiting to be matched, which ages out entries
+    after a time-to-live and never holds more than a fixed number of them.
+
+    Entries are kept in insertion order, which is also expiry order, so
+    finding expired entries only looks at the oldest ones.
+    """
+    def __init__(self, ttl, cap):
+        self.ttl = ttl
+        self.cap = cap
+        self._entries = collections.OrderedDict()
+
+        # Statistics
+        self.ct_expired = 0
+        self.ct_evicted = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __setitem__(self, key, value):
+        self._entries[key] = (time.monotonic(), value)
+
+    def pop(self, key):
+        """
+        Remove the entry for ``key`` and return its value.
+        """
+        return self._entries.pop(key)[1]
+
+    def expire(self, now=None):
+        """
+        Remove entries which are older than the time-to-live, and the oldest
+        entries beyond the capacity of the table.
+
+        :returns: list -- The values of the removed entries, oldest first.
+        """
+        now = time.monotonic() if now is None else now
+        entries = self._entries
+        removed = []
+
+        while len(entries) > self.cap:
+            removed.append(entries.popitem(last=False)[1][1])
+            self.ct_evicted += 1
+
+        while entries:
+            (inserted, value) = next(iter(entries.values()))
+            if now - inserted < self.ttl:
+                break
+            entries.popitem(last=False)
+            removed.append(value)
+            self.ct_expired += 1
+
+        return removed
+
+    def drain(self):
+        """
+        Remove all entries.
+
+        :returns: list -- The values of the removed entries, oldest first.
+        """
+        values = [value for (_, value) in self._entries.values()]
+        self._entries.clear()
+        return values
+
+class CorrelationIndex:
+    """
+    An index of unmatched records for the merger, which may hold several
+    records under the same key, each with the time it refers to. A record
+    is only matched by a lookup for a time window it falls into, so that
+    records of different connections which share a key, because a target
+    is repeated or a source port is reused, are not confused.
+
+    As with :class:`ExpiringTable`, entries age out after a time-to-live,
+    no more than a fixed number of them are held, and entries are kept in
+    insertion order, which is also expiry order.
+    """
+    def __init__(self, ttl, cap):
+        self.ttl = ttl
+        self.cap = cap
+        # serial -> (inserted, key, when, value)
+        self._entries = collections.OrderedDict()
+        # key -> serials of its entries, oldest first
+        self._keys = {}
+        self._serials = itertools.count()
+
+        # Statistics
+        self.ct_expired = 0
+        self.ct_evicted = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, when, value):
+        """
+        Add a record under ``key``, referring to time ``when`` (or None).
+
+        :returns: bool -- True if there were already records under the key.
+        """
+        serial = next(self._serials)
+        self._entries[serial] = (time.monotonic(), key, when, value)
+        serials = self._keys.get(key)
+        if serials is None:
+            self._keys[key] = [serial]
+            return False
+        serials.append(serial)
+        return True
+
+    def match(self, key, earliest=None, latest=None):
+        """
+        Remove and return the oldest record under ``key`` whose time is
+        between ``earliest`` and ``latest``. Records without a time, or a
+        lookup without a window, match any time.
+
+        :returns: The record, or None if there is no match.
+        """
+        serials = self._keys.get(key)
+        if serials is None:
+            return None
+
+        for serial in serials:
+            when = self._entries[serial][2]
+            if (when is None or earliest is None or
+                    earliest <= when <= latest):
+                self._remove(serial)
+                return self._entries.pop(serial)[3]
+        return None
+
+    def _remove(self, serial):
+        key = self._entries[serial][1]
+        serials = self._keys[key]
+        serials.remove(serial)
+        if not serials:
+            del self._keys[key]
+
+    def expire(self, now=None):
+        """
+        Remove entries which are older than the time-to-live, and the oldest
+        entries beyond the capacity of the table.
+
+        :returns: list -- The values of the removed entries, oldest first.
+        """
+        now = time.monotonic() if now is None else now
+        entries = self._entries
+        removed = []
+
+        while len(entries) > self.cap:
+            serial = next(iter(entries))
+            self._remove(serial)
+            removed.append(entries.pop(serial)[3])
+            self.ct_evicted += 1
+
+        while entries:
+            serial = next(iter(entries))
+            if now - entries[serial][0] < self.ttl:
+                break
+            self._remove(serial)
+            removed.append(entries.pop(serial)[3])
+            self.ct_expired += 1
+
+        return removed
+
+    def drain(self):
+        """
+        Remove all entries.
+
+        :returns: list -- The values of the removed entries, oldest first.
+        """
+        values = [entry[3] for entry in self._entries.values()]
+        self._entries.clear()
+        self._keys.clear()
+        return values
+
+class JobTracker:
+    """
+    Keeps track of the jobs whose results have not all been merged yet, to
+    find the low watermark: the number of the oldest such job, before which
+    every job has been merged.
+
+    Jobs must be added in increasing order of their numbers, as the job
+    feeder numbers them by their position in the input. Each job has one
+    result for each configuration.
+    """
+    def __init__(self, results_per_job=2):
+        self.results_per_job = results_per_job
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        self._next = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, jobid):
+        with self._lock:
+            self._pending[jobid] = self.results_per_job
+            self._next = jobid + 1
+
+    def merged(self, jobid):
+        """
+        Record that one of the results of a job has been merged.
+        """
+        with self._lock:
+            remaining = self._pending.get(jobid)
+            if remaining is None:
+                return
+            if remaining > 1:
+                self._pending[jobid] = remaining - 1
+            else:
+                del self._pending[jobid]
+
+    def watermark(self):
+        """
+        :returns: int -- The number of the oldest job not yet merged, or one
+                  past the newest job if all have been, or None if no jobs
+                  have been added.
+        """
+        with self._lock:
+            if self._pending:
+                return next(iter(self._pending))
+            return self._next
 
 QUEUE_SIZE = 1000
 QUEUE_SLEEP = 0.5
 
+# Unmatched flows and results are held this many seconds: as long as an
+# observer may hold a flow after its last packet, and a minute more for
+# results from slow configuration phases
+MERGE_TTL = FLOW_MAX_HOLD + 60
+MERGE_CAP = 100000
+
+# A flow matches a result if its first packet was seen between MATCH_SLACK
+# seconds before and MATCH_WINDOW seconds after the worker started
+# connecting
+MATCH_WINDOW = 60
+MATCH_SLACK = 1
+
+SOURCE_PORTS_PER_WORKER = 64
+# A source port is not bound again for a connection to the same address and
+# port for this many seconds, as long as Linux keeps a closed connection in
+# TIME_WAIT
+SOURCE_PORT_REUSE_DELAY = 60
+
+FLOW_BATCH_SIZE = 100
+FLOW_BATCH_DELAY = 0.1
+
+JOB_BATCH_SIZE = 1
+
+ENGINE_THREADS = "threads"
+ENGINE_ASYNCIO = "asyncio"
+
 SHUTDOWN_SENTINEL = None
 NO_FLOW = None
 
+class Job(list):
+    """
+    A job record, numbered by its position in the input, or in the order
+    jobs were added to the spider.
+    """
+    def __init__(self, row, jobid):
+        super().__init__(row)
+        self.jobid = jobid
+
+# Put on the output queue by the merger when checkpointing, once all the
+# results of the jobs numbered below ``jobs`` have been merged
+Checkpoint = collections.namedtuple("Checkpoint", ["jobs"])
+
+# Passed back from a worker process when its workers have shut down, with
+# their configurator waits and source port fallbacks and clashes, or with an
+# error when one of them failed
+_GroupDone = collections.namedtuple("_GroupDone",
+                                    ["group", "workers", "jobs", "error",
+                                     "wait_seconds", "source_port_fallbacks",
+                                     "source_port_clashes"])
+
+async def sock_connect(sock, address, timeout=None):
+    """
+    Connect a socket to an address from a coroutine, without blocking the
+    event loop.
+
+    :param sock: The socket to connect. It will be made non-blocking.
+    :type sock: socket.socket
+    :param address: The address to connect to, as an IP address literal.
+    :type address: tuple
+    :param timeout: Seconds to wait for the connection, or None to wait
+                    forever.
+    :type timeout: float
+    :raises TimeoutError: if the connection is not established in time.
+    :raises OSError: if the connection fails.
+    """
+    sock.setblocking(False)
+    loop = asyncio.get_event_loop()
+    try:
+        await asyncio.wait_for(loop.sock_connect(sock, address), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError("connection timed out") from None
+
 class Spider:
     """
     A spider consists of a configurator (which alternates between two system
@@ -105,6 +528,19 @@ class Spider:
 
     """
 
+    # Set by plugins which implement configure_socket, and so can run in
+    # barrier-free mode
+    per_socket_config = False
+
+    # Set by plugins which call bind_source on every socket whose flow is
+    # merged with a result, so that with source ports given the observers
+    # can ignore flows on other ports
+    binds_source_ports = False
+
+    # The fields of the merged results to write, for
+    # pathspider.sinks.ResultEncoder; None to write them whole
+    result_schema = None
+
     def __init__(self, worker_count, libtrace_uri):
         """
         The initialisation of a pathspider plugin.
@@ -138,37 +574,97 @@ class Spider:
         self.active_worker_count = 0
         self.active_worker_lock = threading.Lock()
 
+        # Number of jobs each worker runs per configuration change; set to
+        # more than 1 to need fewer configuration changes
+        self.job_batch_size = JOB_BATCH_SIZE
+        self.jobs_completed = 0
+
+        # Run workers as threads, or as coroutines on one event loop
+        self.engine = ENGINE_THREADS
+
+        # Configure each socket with configure_socket() instead of changing
+        # the system configuration, so that workers need not wait for each
+        # other (only for plugins with per_socket_config)
+        self.barrier_free = False
+
+        # Number of processes to divide the workers between; set to more
+        # than 1 to spread the work of the workers over several CPUs
+        self.worker_group_count = 1
+        # Set in worker processes to the number of the group they run, and
+        # the number of its first worker among all the workers
+        self.worker_group = None
+        self.worker_offset = 0
+        self.worker_group_processes = []
+
         self.libtrace_uri = libtrace_uri
 #        self.check_interrupt = check_interrupt
 
-        self.sem_config_zero = SemaphoreN(worker_count)
-        self.sem_config_zero.empty()
-        self.sem_config_zero_rdy = SemaphoreN(worker_count)
-        self.sem_config_zero_rdy.empty()
-        self.sem_config_one = SemaphoreN(worker_count)
-        self.sem_config_one.empty()
-        self.sem_config_one_rdy = SemaphoreN(worker_count)
-        self.sem_config_one_rdy.empty()
+        # Synchronises the configurator and the workers; shared with the
+        # worker processes when running worker groups.
+        self.config_barrier = PhaseBarrier()
+        self.config_changes = 0
+        self.config_metrics = ConfiguratorMetrics()
+
+        # Write the configurator metrics to this file periodically
+        self.metrics_file = None
+        self.metrics_format = METRICS_JSONL
+        self.metrics_interval = 10
+        self.metrics_exporter = None
 
         self.jobqueue = queue.Queue(QUEUE_SIZE)
         self.resqueue = queue.Queue(QUEUE_SIZE)
 
+        # Wakes the merger when a result is put on the result queue
+        (self._res_wakeup_r, self._res_wakeup_w) = os.pipe()
+        os.set_blocking(self._res_wakeup_r, False)
+        os.set_blocking(self._res_wakeup_w, False)
+
         self.flowqueue = mp.Queue(QUEUE_SIZE)
         self.observer_shutdown_queue = mp.Queue(QUEUE_SIZE)
 
-        self.restab = {}
-        self.flowtab = {}
+        # Flows are passed from the observer in lists of up to this many;
+        # set to 1 to pass flows one at a time.
+        self.flow_batch_size = FLOW_BATCH_SIZE
+        self.flow_batch_delay = FLOW_BATCH_DELAY
+
+        self.restab = CorrelationIndex(MERGE_TTL, MERGE_CAP)
+        self.flowtab = CorrelationIndex(MERGE_TTL, MERGE_CAP)
 
         self.outqueue = queue.Queue(QUEUE_SIZE)
 
-        self.observer = None
+        # Put a Checkpoint on the output queue at most this often, in
+        # seconds, for jobs numbered by the job feeder; None to disable.
+        self.checkpoint_interval = None
+        self.job_tracker = JobTracker()
+        self._job_ids = itertools.count()
+
+        # Give each worker its own slice of this many source ports, from
+        # source_port_base, for bind_source(); None to leave the choice of
+        # source ports to the kernel.
+        self.source_port_base = None
+        self.source_ports_per_worker = SOURCE_PORTS_PER_WORKER
+        self._source_port_slots = {}
+        # maps each source port to the target it was last bound for, and when
+        self._source_port_targets = {}
+        self.ct_source_port_fallbacks = 0
+        self.ct_source_port_clashes = 0
+        # Set to make the observers' port range filter track every flow
+        self._port_filter_bypass = None
+
+        # Number of observer processes to split flows between
+        self.observer_count = 1
+        # Log time spent in each observer chain function at shutdown
+        self.observer_profile = False
+        # Store observer flow records compactly, for many concurrent flows
+        self.observer_compact_records = False
+        self.observers = []
 
         self.worker_threads = []
         self.configurator_thread = None
 #        self.interrupter_thread = None
         self.merger_thread = None
 
-        self.observer_process = None
+        self.observer_processes = []
 
 #        self._worker_state = [ "not_started" ] * self.worker_count
 
@@ -177,28 +673,124 @@ class Spider:
 
     def configurator(self):
         """
-        Thread which synchronizes on a set of semaphores and alternates
-        between two system states.
+        Thread which alternates between two system states, synchronized with
+        the workers which have jobs to run.
+
+        The configurator only changes to a configuration once a worker is
+        waiting for it. It then admits the workers waiting at that moment,
+        and waits for all of them to finish connecting before changing
+        configuration again. Idle workers do not take part. If workers are
+        only waiting for the configuration already set, it is kept and
+        another phase is run for them.
         """
         logger = logging.getLogger('pathspider')
 
+        config = 0
+        current = None
+        barrier = self.config_barrier
+        metrics = self.config_metrics
         while self.running:
-            logger.debug("setting config zero")
-            self.config_zero()
-            logger.debug("config zero active")
-            self.sem_config_zero.release_n(self.worker_count)
-            self.sem_config_one_rdy.acquire_n(self.worker_count)
-            logger.debug("setting config one")
-            self.config_one()
-            logger.debug("config one active")
-            self.sem_config_one.release_n(self.worker_count)
-            self.sem_config_zero_rdy.acquire_n(self.worker_count)
-
-        # In case the master exits the run loop before all workers have,
-        # these tokens will allow all workers to run through again,
-        # until the next check at the start of the loop
-        self.sem_config_zero.release_n(self.worker_count)
-        self.sem_config_one.release_n(self.worker_count)
+            # park until a worker wants a configuration, alternating unless
+            # only the other configuration is wanted (by workers which
+            # missed the last phase for it)
+            config = barrier.wait_for_demand(config)
+            if config is None:
+                break
+
+            if config != current:
+                logger.debug("setting config " + str(config))
+                start = time.perf_counter()
+                if config == 0:
+                    self.config_zero()
+                else:
+                    self.config_one()
+                elapsed = time.perf_counter() - start
+                logger.debug("config " + str(config) + " active")
+
+                with metrics.lock:
+                    self.config_changes += 1
+                    metrics.set_seconds[config].observe(elapsed)
+                current = config
+
+            admitted = barrier.open(config)
+            start = time.perf_counter()
+
+            # wait for the admitted workers to enter and leave
+            done = barrier.wait_for_users()
+            barrier.close()
+
+            with metrics.lock:
+                metrics.phase_workers[config].observe(admitted)
+                metrics.phase_seconds[config].observe(
+                        time.perf_counter() - start)
+            if not done:
+                break
+
+            config = 1 - config
+
+    def enter_config(self, config, timeout=None):
+        """
+        Wait for the configurator to set a configuration, and mark this
+        worker as connecting in it. The configuration will not change until
+        :func:`leave_config` is called.
+
+        :param config: The configuration to wait for (0 or 1).
+        :type config: int
+        :param timeout: The longest time in seconds to wait, or None to
+                        wait until the configuration is set.
+        :type timeout: float
+        :returns: bool -- False if the spider stopped running or the wait
+                  timed out.
+
+        In barrier-free mode, this returns immediately.
+        """
+        if self.barrier_free:
+            return True
+
+        start = time.perf_counter()
+        if not self.config_barrier.enter(config, timeout):
+            return False
+
+        metrics = self.config_metrics
+        with metrics.lock:
+            metrics.wait_seconds[config].observe(time.perf_counter() - start)
+        return True
+
+    def leave_config(self, config):
+        """
+        Mark this worker as done with a configuration it entered with
+        :func:`enter_config`.
+        """
+        if self.barrier_free:
+            return
+
+        self.config_barrier.leave(config)
+
+    def _log_config_stats(self):
+        logger = logging.getLogger('pathspider')
+
+        jobs = self.jobs_completed
+        logger.info("configurator: %u configuration changes for %u jobs "
+                    "(%.1f per 1000 jobs, batch size %u)",
+                    self.config_changes, jobs,
+                    self.config_changes * 1000 / jobs if jobs else 0,
+                    self.job_batch_size)
+        metrics = self.config_metrics
+        for config in (0, 1):
+            set_seconds = metrics.set_seconds[config]
+            if set_seconds.count:
+                logger.info("configurator: config %u set %u times, "
+                            "mean %.3f ms, max %.3f ms", config,
+                            set_seconds.count, set_seconds.mean() * 1e3,
+                            set_seconds.max * 1e3)
+            phase_seconds = metrics.phase_seconds[config]
+            if phase_seconds.count:
+                logger.info("configurator: config %u phases %u, "
+                            "mean %.3f ms, max %.3f ms, mean %.1f workers",
+                            config, phase_seconds.count,
+                            phase_seconds.mean() * 1e3,
+                            phase_seconds.max * 1e3,
+                            metrics.phase_workers[config].mean())
 
     def config_zero(self):
         """
@@ -216,6 +808,158 @@ class Spider:
 
         raise NotImplementedError("Cannot instantiate an abstract Pathspider")
 
+    def configure_socket(self, sock, config):
+        """
+        Applies a configuration to a single socket, in barrier-free mode.
+
+        :param sock: The socket, before it is connected.
+        :type sock: socket.socket
+        :param config: The configuration to apply (0 or 1).
+        :type config: int
+
+        Plugins whose configurations can be applied to each socket, rather
+        than to the whole system, can implement this function and set
+        :attr:`per_socket_config`. In barrier-free mode, the configurator is
+        not started, A and B connections of different jobs run at the same
+        time, and the plugin's connect function must call this function on
+        each socket it creates.
+        """
+
+        raise NotImplementedError("This plugin has no per-socket configuration")
+
+    def source_port_range(self):
+        """
+        :returns: tuple -- The first and one past the last source port
+                  given to the workers, or None if source ports are left to
+                  the kernel.
+        """
+        if self.source_port_base is None:
+            return None
+        return (self.source_port_base, self.source_port_base +
+                self.worker_count * self.source_ports_per_worker)
+
+    def bind_source(self, sock, job):
+        """
+        Bind a socket to the next source port in the slice of the worker
+        running a job, cycling through the slice.
+
+        :param sock: The socket, before it is connected.
+        :type sock: socket.socket
+        :param job: The job the socket is for.
+        :returns: int -- The port bound, or None if the socket was left for
+                  the kernel to choose an ephemeral port.
+
+        With :attr:`source_port_base` set, worker ``n`` uses the ports from
+        ``source_port_base + n * source_ports_per_worker``, so the worker
+        which made a flow is known from its source port alone, and the
+        observers of plugins setting :attr:`binds_source_ports` ignore
+        flows outside the workers' ports. The socket is bound with
+        SO_REUSEADDR, so that a port can be reused while an earlier
+        connection from it is in TIME_WAIT. A port which is still in use or
+        not available is skipped for the next in the slice, as is one bound
+        for the same address and port in the last
+        :data:`SOURCE_PORT_REUSE_DELAY` seconds, whose earlier connection
+        may still be in TIME_WAIT; see :func:`source_port_clash`. If no port
+        in the slice can be bound, the kernel chooses one as usual, and the
+        observers track flows on all ports from then on, so that the
+        connection is still observed. Plugins should call this function on
+        each socket they connect; it does nothing if source ports are not
+        configured.
+        """
+        if self.source_port_base is None:
+            return None
+
+        worker = getattr(job, 'worker', None)
+        if worker is None:
+            self._source_port_fallback("job has no worker")
+            return None
+
+        if sock.family == socket.AF_INET6:
+            host = '::'
+        else:
+            host = '0.0.0.0'
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        except OSError as e:
+            self._source_port_fallback(str(e))
+            return None
+
+        # each worker only uses its own slot counter and ports
+        target = (job[0], job[1])
+        now = time.monotonic()
+        targets = self._source_port_targets
+        per_worker = self.source_ports_per_worker
+        first = self._source_port_slots.get(worker, 0)
+        for i in range(per_worker):
+            slot = (first + i) % per_worker
+            port = self.source_port_base + worker * per_worker + slot
+            last = targets.get(port)
+            if (last is not None and last[0] == target and
+                    now - last[1] < SOURCE_PORT_REUSE_DELAY):
+                continue
+            try:
+                sock.bind((host, port))
+            except OSError as e:
+                if e.errno in (errno.EADDRINUSE, errno.EADDRNOTAVAIL):
+                    continue
+                self._source_port_fallback("port %u: %s" % (port, e))
+                return None
+            self._source_port_slots[worker] = (slot + 1) % per_worker
+            targets[port] = (target, now)
+            return port
+
+        self._source_port_fallback("all ports of worker %u in use" % worker)
+        return None
+
+    def source_port_clash(self, sock, error):
+        """
+        Check whether a connection failed only because the source port
+        :func:`bind_source` gave its socket still has a connection to the
+        same address and port in TIME_WAIT, which connect reports as
+        EADDRNOTAVAIL. This is not a failure of the target: the plugin
+        should close the socket and connect again with a new one, which
+        :func:`bind_source` binds to another port, or leaves to the kernel
+        once no other port is left.
+
+        :param sock: The socket which failed to connect.
+        :type sock: socket.socket
+        :param error: The exception raised by connect.
+        :type error: OSError
+        :returns: bool -- True if the connection should be made again.
+        """
+        if (self.source_port_base is None or
+                getattr(error, 'errno', None) != errno.EADDRNOTAVAIL):
+            return False
+        try:
+            port = sock.getsockname()[1]
+        except OSError:
+            return False
+        (low, high) = self.source_port_range()
+        if not low <= port < high:
+            return False
+
+        logger = logging.getLogger('pathspider')
+        logger.debug("source port %u is in TIME_WAIT, connecting again", port)
+        with self.active_worker_lock:
+            self.ct_source_port_clashes += 1
+        return True
+
+    def _source_port_fallback(self, reason):
+        """
+        Count a connection left to an ephemeral source port, and make the
+        observers track flows on all ports, so that it is not lost.
+        """
+        logger = logging.getLogger('pathspider')
+        logger.debug("cannot bind a source port (%s), "
+                     "using an ephemeral port", reason)
+        with self.active_worker_lock:
+            self.ct_source_port_fallbacks += 1
+            bypass = self._port_filter_bypass
+            if bypass is not None and not bypass.value:
+                bypass.value = 1
+                logger.warning("a connection could not bind a source port, "
+                               "observers now track flows on all ports")
+
     # def interrupter(self):
     #     if self.check_interrupt is None:
     #         return
@@ -241,103 +985,353 @@ class Spider:
 
         The workers operate as continuous loops:
 
-         * Fetch next job from the job queue
-         * Perform pre-connection operations
-         * Acquire a lock for "config_zero"
-         * Perform the "config_zero" connection
+         * Fetch the next batch of up to ``job_batch_size`` jobs from the job
+           queue, waiting for the first if none are available
+         * Perform pre-connection operations for each job
+         * Wait for the configurator to set "config_zero"
+         * Perform the "config_zero" connection for each job
          * Release "config_zero"
-         * Acquire a lock for "config_one"
-         * Perform the "config_one" connection
+         * Wait for the configurator to set "config_one"
+         * Perform the "config_one" connection for each job
          * Release "config_one"
          * Perform post-connection operations for config_zero and pass the
-           result to the merger
+           result to the merger, for each job
          * Perform post-connection operations for config_one and pass the
-           result to the merger
+           result to the merger, for each job
          * Do it all again
-        
+
+        A worker waiting for a job does not hold up the configurator.
+        Batching jobs divides the number of configuration changes needed by
+        up to the batch size, at the cost of a longer wait between the
+        "config_zero" and "config_one" connections of each job.
+
         If the job fetched is the SHUTDOWN_SENTINEL, then the worker will
         terminate as this indicates that all the jobs have now been processed.
         """
 
         logger = logging.getLogger('pathspider')
-        worker_active = True
 
-        while self.running:
-            if worker_active:
+        shutdown = False
+        while self.running and not shutdown:
+            try:
+                job = self.jobqueue.get(timeout=QUEUE_SLEEP)
+            except queue.Empty:
+                continue
+
+            # Fill the batch with any further jobs already queued
+            jobs = []
+            while True:
+                if job == SHUTDOWN_SENTINEL:
+                    shutdown = True
+                    break
+                jobs.append(job)
+                if len(jobs) >= self.job_batch_size:
+                    break
                 try:
                     job = self.jobqueue.get_nowait()
-
-                    # Break on shutdown sentinel
-                    if job == SHUTDOWN_SENTINEL:
-                        self.jobqueue.task_done()
-                        logger.debug("shutting down worker "+str(worker_number)+" on sentinel")
-                        #self._worker_state[worker_number] = "shutdown_sentinel"
-                        worker_active = False
-                        with self.active_worker_lock:
-                            self.active_worker_count -= 1
-                            logger.debug(str(self.active_worker_count)+" workers still active")
-                        continue
-
-                    logger.debug("got a job: "+repr(job))
                 except queue.Empty:
-                    #logger.debug("no job available, sleeping")
-                    # spin the semaphores
-                    self.sem_config_zero.acquire()
-                    #self._worker_state[worker_number] = "sleep_0"
-                    time.sleep(QUEUE_SLEEP)
-                    self.sem_config_one_rdy.release()
-                    self.sem_config_one.acquire()
-                    #self._worker_state[worker_number] = "sleep_1"
-                    time.sleep(QUEUE_SLEEP)
-                    self.sem_config_zero_rdy.release()
-                else:
-                    # Hook for preconnection
-                    #self._worker_state[worker_number] = "preconn"
-                    pcs = self.pre_connect(job)
-
-                    # Wait for configuration zero
-                    #self._worker_state[worker_number] = "wait_0"
-                    self.sem_config_zero.acquire()
-
-                    # Connect in configuration zero
-                    #self._worker_state[worker_number] = "conn_0"
-                    conn0 = self.connect(job, pcs, 0)
-
-                    # Wait for configuration one
-                    #self._worker_state[worker_number] = "wait_1"
-                    self.sem_config_one_rdy.release()
-                    self.sem_config_one.acquire()
-
-                    # Connect in configuration one
-                    #self._worker_state[worker_number] = "conn_1"
-                    conn1 = self.connect(job, pcs, 1)
-
-                    # Signal okay to go to configuration zero
-                    self.sem_config_zero_rdy.release()
-
-                    # Pass results on for merge
-                    #self._worker_state[worker_number] = "postconn_0"
-                    self.resqueue.put(self.post_connect(job, conn0, pcs, 0))
-                    #self._worker_state[worker_number] = "postconn_1"
-                    self.resqueue.put(self.post_connect(job, conn1, pcs, 1))
-
-                    #self._worker_state[worker_number] = "done"
-                    logger.debug("job complete: "+repr(job))
-                    self.jobqueue.task_done()
-            else: # not worker_active, spin the semaphores
-                self.sem_config_zero.acquire()
-                #self._worker_state[worker_number] = "shutdown_0"
-                time.sleep(QUEUE_SLEEP)
+                    break
+
+            if jobs:
+                logger.debug("got %u jobs: %r", len(jobs), jobs)
+                if not self._run_jobs(jobs, worker_number):
+                    break
+
+            # Break on shutdown sentinel
+            if shutdown:
+                self.jobqueue.task_done()
+                logger.debug("shutting down worker "+str(worker_number)+" on sentinel")
+                with self.active_worker_lock:
+                    self.active_worker_count -= 1
+                    logger.debug(str(self.active_worker_count)+" workers still active")
+
+    def _run_jobs(self, jobs, worker_number=None):
+        """
+        Run a batch of jobs in both configurations, and pass the results to
+        the merger.
+
+        :returns: bool -- False if the spider stopped running before the
+                  jobs could be run.
+        """
+        logger = logging.getLogger('pathspider')
+
+        self._assign_worker(jobs, worker_number)
+
+        # Hook for preconnection
+        pcss = [self.pre_connect(job) for job in jobs]
+
+        # Connect in configuration zero
+        if not self.enter_config(0):
+            return False
+        try:
+            conns0 = [self._connect_timed(job, pcs, 0)
+                      for (job, pcs) in zip(jobs, pcss)]
+        finally:
+            self.leave_config(0)
+
+        # Connect in configuration one
+        if not self.enter_config(1):
+            return False
+        try:
+            conns1 = [self._connect_timed(job, pcs, 1)
+                      for (job, pcs) in zip(jobs, pcss)]
+        finally:
+            self.leave_config(1)
+
+        # Pass results on for merge
+        for (job, pcs, (conn0, started0), (conn1, started1)) in zip(
+                jobs, pcss, conns0, conns1):
+            jobid = getattr(job, 'jobid', None)
+            self.put_result(self.post_connect(job, conn0, pcs, 0), jobid,
+                            started0)
+            self.put_result(self.post_connect(job, conn1, pcs, 1), jobid,
+                            started1)
+
+            logger.debug("job complete: "+repr(job))
+            self.jobqueue.task_done()
+
+        with self.active_worker_lock:
+            self.jobs_completed += len(jobs)
+
+        return True
+
+    def _connect_timed(self, job, pcs, config):
+        """
+        Run :func:`connect` for a job, and return its result with the time
+        the connection was started, to match the job's result with its flow.
+        """
+        started = time.time()
+        return (self.connect(job, pcs, config), started)
+
+    def _assign_worker(self, jobs, worker_number):
+        # record the worker running each job, for bind_source()
+        for job in jobs:
+            if isinstance(job, Job):
+                job.worker = worker_number
+
+    def async_engine(self):
+        """
+        Thread which runs the workers as coroutines on an asyncio event loop,
+        for the "asyncio" engine.
+
+        The coroutine workers follow the same steps as :func:`worker`, but
+        connect with :func:`connect_async`, so that one thread can wait for
+        thousands of connections at once. Towards the configurator, the whole
+        event loop takes part as a single worker: a coordinator coroutine
+        waits for each configuration on behalf of all the coroutine workers
+        waiting for it, so the A/B barrier semantics are unchanged.
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._async_main())
+        finally:
+            loop.close()
+
+    async def _async_main(self):
+        loop = asyncio.get_event_loop()
+
+        # Coroutine worker state, protected by _async_cond, as for the
+        # configurator state
+        self._async_cond = asyncio.Condition()
+        self._async_state = None
+        self._async_waiting = [0, 0]
+        self._async_admitted = 0
+        self._async_users = 0
+        self._async_stopped = False
+
+        jobs = asyncio.Queue(self.worker_count)
+        workers = [loop.create_task(self.async_worker(self.worker_offset + i,
+                                                      jobs))
+                   for i in range(self.worker_count)]
+        coordinator = loop.create_task(self._async_coordinator())
+
+        try:
+            await self._async_feeder(jobs)
+            if not self.running:
+                await self._async_stop()
+            await asyncio.gather(*workers)
+        finally:
+            coordinator.cancel()
+            for worker in workers:
+                worker.cancel()
+
+    async def _async_feeder(self, jobs):
+        """
+        Pass jobs from the job queue to the coroutine workers, until each of
+        them has been passed a shutdown sentinel or the spider stops.
+        """
+        loop = asyncio.get_event_loop()
+
+        sentinels = 0
+        while self.running and sentinels < self.worker_count:
+            try:
+                job = await loop.run_in_executor(None, self.jobqueue.get,
+                                                 True, QUEUE_SLEEP)
+            except queue.Empty:
+                continue
+
+            if job == SHUTDOWN_SENTINEL:
+                sentinels += 1
+            await jobs.put(job)
+
+    async def _async_stop(self):
+        async with self._async_cond:
+            self._async_stopped = True
+            self._async_cond.notify_all()
+
+    async def _async_coordinator(self):
+        """
+        Enter each configuration on behalf of the coroutine workers waiting
+        for it, in the same order as the configurator sets them.
+        """
+        loop = asyncio.get_event_loop()
+        cond = self._async_cond
+
+        config = 0
+        while True:
+            async with cond:
+                await cond.wait_for(lambda: any(self._async_waiting))
+
+                # alternate, as the configurator does
+                if self._async_waiting[config] == 0:
+                    config = 1 - config
+
+            if not await loop.run_in_executor(None, self.enter_config, config):
+                await self._async_stop()
+                return
+
+            try:
+                async with cond:
+                    self._async_state = config
+                    self._async_admitted = self._async_waiting[config]
+                    cond.notify_all()
+
+                    await cond.wait_for(lambda: self._async_admitted == 0 and
+                                                self._async_users == 0)
+                    self._async_state = None
+            finally:
+                self.leave_config(config)
+
+            config = 1 - config
+
+    async def _async_enter_config(self, config):
+        if self.barrier_free:
+            return True
+
+        cond = self._async_cond
+        async with cond:
+            self._async_waiting[config] += 1
+            cond.notify_all()
+
+            await cond.wait_for(lambda: self._async_stopped or
+                                        (self._async_state == config and
+                                         self._async_admitted > 0))
+
+            self._async_waiting[config] -= 1
+            if self._async_stopped:
+                return False
+            self._async_admitted -= 1
+            self._async_users += 1
+            return True
+
+    async def _async_leave_config(self, config):
+        if self.barrier_free:
+            return
+
+        cond = self._async_cond
+        async with cond:
+            self._async_users -= 1
+            if self._async_users == 0 and self._async_admitted == 0:
+                cond.notify_all()
+
+    async def async_worker(self, worker_number, jobs):
+        """
+        The coroutine equivalent of :func:`worker`, used by the "asyncio"
+        engine. Jobs are taken from ``jobs``, an :class:`asyncio.Queue` fed
+        from the job queue. The connections for the jobs of a batch are
+        made concurrently.
+        """
+        logger = logging.getLogger('pathspider')
+
+        shutdown = False
+        while not shutdown:
+            job = await jobs.get()
+
+            batch = []
+            while True:
+                if job == SHUTDOWN_SENTINEL:
+                    shutdown = True
+                    break
+                batch.append(job)
+                if len(batch) >= self.job_batch_size:
+                    break
+                try:
+                    job = jobs.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+
+            if batch:
+                logger.debug("got %u jobs: %r", len(batch), batch)
+                if not await self._run_jobs_async(batch, worker_number):
+                    break
+
+            if shutdown:
+                self.jobqueue.task_done()
+                logger.debug("shutting down worker "+str(worker_number)+" on sentinel")
                 with self.active_worker_lock:
-                    if self.active_worker_count <= 0:
-                        #self._worker_state[worker_number] = "shutdown_complete"
-                        break
-                self.sem_config_one_rdy.release()
-                self.sem_config_one.acquire()
-                #self._worker_state[worker_number] = "shutdown_1"
-                time.sleep(QUEUE_SLEEP)
-                self.sem_config_zero_rdy.release()
+                    self.active_worker_count -= 1
+                    logger.debug(str(self.active_worker_count)+" workers still active")
+
+    async def _connect_timed_async(self, job, pcs, config):
+        """
+        The coroutine equivalent of :func:`_connect_timed`.
+        """
+        started = time.time()
+        return (await self.connect_async(job, pcs, config), started)
+
+    async def _run_jobs_async(self, jobs, worker_number=None):
+        """
+        The coroutine equivalent of :func:`_run_jobs`.
+        """
+        logger = logging.getLogger('pathspider')
+
+        self._assign_worker(jobs, worker_number)
+        pcss = [self.pre_connect(job) for job in jobs]
+
+        if not await self._async_enter_config(0):
+            return False
+        try:
+            conns0 = await asyncio.gather(
+                    *[self._connect_timed_async(job, pcs, 0)
+                      for (job, pcs) in zip(jobs, pcss)])
+        finally:
+            await self._async_leave_config(0)
+
+        if not await self._async_enter_config(1):
+            return False
+        try:
+            conns1 = await asyncio.gather(
+                    *[self._connect_timed_async(job, pcs, 1)
+                      for (job, pcs) in zip(jobs, pcss)])
+        finally:
+            await self._async_leave_config(1)
 
+        for (job, pcs, (conn0, started0), (conn1, started1)) in zip(
+                jobs, pcss, conns0, conns1):
+            jobid = getattr(job, 'jobid', None)
+            self.put_result(self.post_connect(job, conn0, pcs, 0), jobid,
+                            started0)
+            self.put_result(self.post_connect(job, conn1, pcs, 1), jobid,
+                            started1)
+
+            logger.debug("job complete: "+repr(job))
+            self.jobqueue.task_done()
+
+        with self.active_worker_lock:
+            self.jobs_completed += len(jobs)
+
+        return True
 
     def pre_connect(self, job):
         """
@@ -383,6 +1377,24 @@ class Spider:
 
         raise NotImplementedError("Cannot instantiate an abstract Pathspider")
 
+    async def connect_async(self, job, pcs, config):
+        """
+        Performs the connection, for the "asyncio" engine.
+
+        This is a coroutine taking the same arguments and returning the same
+        result as :func:`pathspider.base.Spider.connect`, which must not block
+        the event loop; :func:`pathspider.base.sock_connect` connects a socket
+        without blocking.
+
+        Plugins to PATHspider can optionally implement this function. If this
+        function is not overloaded, :func:`pathspider.base.Spider.connect` is
+        run in a thread pool, which limits the number of connections in
+        progress at once to the size of the pool.
+        """
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.connect, job, pcs, config)
+
     def post_connect(self, job, conn, pcs, config):
         """
         Performs post-connection operations.
@@ -431,78 +1443,279 @@ class Spider:
 
         raise NotImplementedError("Cannot instantiate an abstract Pathspider")
 
+    def put_result(self, res, jobid=None, started=None):
+        """
+        Pass a result to the merger.
+
+        :param res: The result of :func:`pathspider.base.Spider.post_connect`.
+        :param jobid: The number of the job the result is for.
+        :param started: The time the connection was started, as from
+                        :func:`time.time`, to match the result with its
+                        flow; None to match any flow with the same
+                        addresses and ports.
+        """
+
+        item = (jobid, started, res)
+        if self.worker_group is not None:
+            # in a worker process; the parent passes results on
+            self._group_resqueue.put(item)
+            return
+
+        self._queue_result(item)
+
+    def _queue_result(self, item):
+        self.resqueue.put(item)
+        try:
+            os.write(self._res_wakeup_w, b'\0')
+        except BlockingIOError:
+            # the pipe is full, so the merger has wakeups pending anyway
+            pass
+
     def merger(self):
         """
         Thread to merge results from the workers and the observer.
+
+        The merger sleeps until either the observer has written flows into
+        the flow queue's pipe or a worker has signalled a new result through
+        :func:`put_result`, then merges everything available from both.
+
+        A result is matched with a flow with the same remote address,
+        remote port and local port, whose first packet was seen from
+        :data:`MATCH_SLACK` seconds before to :data:`MATCH_WINDOW` seconds
+        after the connection was started. Several results and flows may wait
+        under the same addresses and ports, when a target is repeated or a
+        source port is reused.
+
+        Flows and results that have not been matched are held in
+        :attr:`flowtab` and :attr:`restab` for at most ``ttl`` seconds, and
+        at most ``cap`` of each are held at once (by default
+        :data:`MERGE_TTL` and :data:`MERGE_CAP`). The TTL is longer than an
+        observer holds a flow after its last packet, since the observers
+        complete idle flows (see :data:`pathspider.observer.FLOW_MAX_HOLD`).
+        Results that age out are merged with NO_FLOW; flows that age out are orphaned, and dropped.
+        The merger counts the results matched with flows, the records which
+        shared their key with others waiting, and the orphaned flows.
+
+        With a :attr:`checkpoint_interval`, the merger also puts a
+        :class:`Checkpoint` on the output queue whenever the low watermark of
+        merged jobs has advanced, at most once per interval and once more
+        when it finishes. Everything merged for the jobs before the
+        watermark has been put on the output queue ahead of it.
         """
 
         logger = logging.getLogger('pathspider')
-        merging_flows = True
-        merging_results = True
+        self._merging_flows = True
+        self._merging_results = True
+        self._observers_running = len(self.observer_processes)
+
+        self._ct_flows_received = 0
+        self._ct_flow_puts = 0
+        self.ct_results = 0
+        self.ct_matched = 0
+        self.ct_duplicates = 0
+        self.ct_orphaned = 0
+        start = time.monotonic()
+        self._last_checkpoint = None
+        self._last_checkpoint_time = start
+
+        # the reading end of the flow queue's pipe becomes readable
+        # as soon as the observer process has flushed a flow into it
+        selector = selectors.DefaultSelector()
+        selector.register(self.flowqueue._reader, selectors.EVENT_READ)
+        selector.register(self._res_wakeup_r, selectors.EVENT_READ)
+
+        while self.running and self._merging_results:
+            self._expire_merge_tables()
+
+            for (key, _) in selector.select(timeout=QUEUE_SLEEP):
+                if key.fileobj == self._res_wakeup_r:
+                    self._drain_wakeups()
+
+            self._merge_available_results()
+
+            if self._merging_flows:
+                self._merge_available_flows()
+                if not self._merging_flows:
+                    selector.unregister(self.flowqueue._reader)
+
+            self._checkpoint()
+
+        # The observer has been joined before the result queue shutdown
+        # sentinel is sent, so any flows it emitted are already in the pipe.
+        if self._merging_flows:
+            self._merge_available_flows()
+        selector.close()
+
+        # Both shutdown markers received.
+        # Call merge on all remaining entries in the results table
+        # with null flows.
+        for item in self.restab.drain():
+            self._merge_result(NO_FLOW, item)
+        self.ct_orphaned += len(self.flowtab.drain())
+        self.flush_merged(final=True)
+        self._checkpoint(force=True)
+
+        elapsed = time.monotonic() - start
+        logger.info("merger received %u flows in %u gets (%.1f flows/s)" % (
+                    self._ct_flows_received, self._ct_flow_puts,
+                    self._ct_flows_received / elapsed if elapsed > 0 else 0))
+        logger.info(("merger matched %u of %u results with flows (%.1f%%), "+
+                     "%u shared their key, %u flows orphaned") % (
+                        self.ct_matched, self.ct_results,
+                        100 * self.ct_matched / self.ct_results
+                        if self.ct_results else 0,
+                        self.ct_duplicates, self.ct_orphaned))
+        logger.info(("merger expired %u results and %u flows, "+
+                     "evicted %u results and %u flows over capacity") % (
+                        self.restab.ct_expired, self.flowtab.ct_expired,
+                        self.restab.ct_evicted, self.flowtab.ct_evicted))
+
+    def _drain_wakeups(self):
+        try:
+            while os.read(self._res_wakeup_r, QUEUE_SIZE):
+                pass
+        except BlockingIOError:
+            pass
 
-        while self.running and merging_results:
-            if self.flowqueue.qsize() >= self.resqueue.qsize():
-                try:
-                    flow = self.flowqueue.get_nowait()
-                except queue.Empty:
-                    time.sleep(QUEUE_SLEEP)
-                else:
-                    if flow == SHUTDOWN_SENTINEL:
-                        logger.debug("stopping flow merging on sentinel")
-                        merging_flows = False
-                        continue
-
-                    flowkey = (flow['dip'], flow['sp'])
-                    logger.debug("got a flow (" + str(flow['sip']) + ", " +
-                                 str(flow['sp']) + ")")
-
-                    if flowkey in self.restab:
-                        logger.debug("merging flow")
-                        self.merge(flow, self.restab[flowkey])
-                        del self.restab[flowkey]
-                    elif flowkey in self.flowtab:
-                        logger.debug("won't merge duplicate flow")
-                    else:
-                        # FIXME: How to keep flowtab from 
-                        # exploding with unrelated flows?
-                        # We need a timer queue for flow expiry. 
-                        # See Issue #30
-                        self.flowtab[flowkey] = flow
+    def _merge_available_flows(self):
+        """
+        Merge flows from the flow queue until it is empty. The observer
+        puts either single flows or lists of flows on the queue.
+        """
+
+        logger = logging.getLogger('pathspider')
+
+        while True:
+            try:
+                flows = self.flowqueue.get_nowait()
+            except queue.Empty:
+                return
+
+            if flows == SHUTDOWN_SENTINEL:
+                self._observers_running -= 1
+                if self._observers_running > 0:
+                    logger.debug("observer finished, %u still running" %
+                                 self._observers_running)
+                    continue
+                logger.debug("stopping flow merging on sentinel")
+                self._merging_flows = False
+                return
+
+            if not isinstance(flows, list):
+                flows = [flows]
+
+            self._ct_flow_puts += 1
+            self._ct_flows_received += len(flows)
+
+            for flow in flows:
+                self._merge_flow(flow)
+
+    def _merge_flow(self, flow):
+        logger = logging.getLogger('pathspider')
+
+        flowkey = (flow['dip'], flow['dp'], flow['sp'])
+        first = flow.get('first')
+        logger.debug("got a flow (" + str(flow['sip']) + ", " +
+                     str(flow['sp']) + ")")
+
+        if first is None:
+            item = self.restab.match(flowkey)
+        else:
+            item = self.restab.match(flowkey, first - MATCH_WINDOW,
+                                     first + MATCH_SLACK)
+        if item is not None:
+            logger.debug("merging flow")
+            self.ct_matched += 1
+            self._merge_result(flow, item)
+        elif self.flowtab.add(flowkey, first, flow):
+            logger.debug("flow shares its key with another")
+            self.ct_duplicates += 1
+
+    def _merge_available_results(self):
+        """
+        Merge results from the result queue until it is empty.
+        """
+
+        logger = logging.getLogger('pathspider')
 
+        while True:
+            try:
+                item = self.resqueue.get_nowait()
+            except queue.Empty:
+                return
+
+            if item == SHUTDOWN_SENTINEL:
+                logger.debug("stopping result merging on sentinel")
+                self._merging_results = False
+                self.resqueue.task_done()
+                return
+
+            (jobid, started, res) = item
+            try:
+                reskey = (res.ip, res.rport, res.port)
+            except AttributeError:
+                raise TypeError("results must have ip, rport and port "
+                                "fields to be merged with their flows, "
+                                "not " + repr(res)) from None
+            logger.debug("got a result (" + str(res.ip) + ", " +
+                         str(res.port) + ")")
+            self.ct_results += 1
+
+            if started is None:
+                flow = self.flowtab.match(reskey)
             else:
-                try:
-                    res = self.resqueue.get_nowait()
-                except queue.Empty:
-                    time.sleep(QUEUE_SLEEP)
-                    logger.debug("result queue is empty")
-                else:
-                    if res == SHUTDOWN_SENTINEL:
-                        merging_results = False
-                        logger.debug("stopping result merging on sentinel")
-                        continue
-
-                    reskey = (res.ip, res.port)
-                    logger.debug("got a result (" + str(res.ip) + ", " +
-                                 str(res.port) + ")")
-
-                    if reskey in self.flowtab:
-                        logger.debug("merging result")
-                        self.merge(self.flowtab[reskey], res)
-                        del self.flowtab[reskey]
-                    elif reskey in self.restab:
-                        logger.debug("won't merge duplicate result")
-                    else:
-                        self.restab[reskey] = res
-
-                    self.resqueue.task_done()
-
-        # Both shutdown markers received. 
-        # Call merge on all remaining entries in the results table 
-        # with null flows.
-        # Commented out for now; see https://github.com/mami-project/pathspider/issues/29 
-        for res_item in self.restab.items():
-            res = res_item[1]
-            self.merge(NO_FLOW, res)
+                flow = self.flowtab.match(reskey, started - MATCH_SLACK,
+                                          started + MATCH_WINDOW)
+            if flow is not None:
+                logger.debug("merging result")
+                self.ct_matched += 1
+                self._merge_result(flow, item)
+            elif self.restab.add(reskey, started, item):
+                logger.debug("result shares its key with another")
+                self.ct_duplicates += 1
+
+            self.resqueue.task_done()
+
+    def _expire_merge_tables(self):
+        """
+        Merge results which have waited too long for a flow with NO_FLOW,
+        and drop flows which have waited too long for a result.
+        """
+
+        for item in self.restab.expire():
+            self._merge_result(NO_FLOW, item)
+
+        self.ct_orphaned += len(self.flowtab.expire())
+        self.flush_merged()
+
+    def _merge_result(self, flow, item):
+        (jobid, _, res) = item
+        self.merge(flow, res)
+        self._result_merged(jobid)
+
+    def _result_merged(self, jobid):
+        if jobid is not None and self.checkpoint_interval is not None:
+            self.job_tracker.merged(jobid)
+
+    def _checkpoint(self, force=False):
+        """
+        Put a :class:`Checkpoint` on the output queue if the low watermark
+        of merged jobs has advanced, and the checkpoint interval has passed
+        or ``force`` is set.
+        """
+        if self.checkpoint_interval is None:
+            return
+
+        now = time.monotonic()
+        if not force and now - self._last_checkpoint_time < \
+                self.checkpoint_interval:
+            return
+        self._last_checkpoint_time = now
+
+        watermark = self.job_tracker.watermark()
+        if watermark is not None and watermark != self._last_checkpoint:
+            self._last_checkpoint = watermark
+            self.outqueue.put(Checkpoint(watermark))
 
     def merge(self, flow, res):
         """
@@ -526,6 +1739,24 @@ class Spider:
 
         raise NotImplementedError("Cannot instantiate an abstract Pathspider")
 
+    def flush_merged(self, final=False):
+        """
+        Emit records held back by :func:`merge`.
+
+        :param final: True when the merger is finishing, and everything
+                      held back must be emitted.
+        :type final: bool
+
+        The merger calls this function regularly, and once more when all
+        the results have been merged. Plugins which hold merged records
+        back, for example to combine the records of both configurations,
+        can implement it to emit the records which have waited too long,
+        and all of them at the end. If this function is not overloaded, it
+        will be a noop.
+        """
+
+        pass
+
     def exception_wrapper(self, target, *args, **kwargs):
         try:
             target(*args, **kwargs)
@@ -536,6 +1767,13 @@ class Spider:
             if self.exception is None:
                 self.exception = sys.exc_info()[1]
 
+            if self.worker_group is not None:
+                # in a worker process; have the parent terminate
+                self._group_resqueue.put(_GroupDone(self.worker_group, 0, 0,
+                                                    repr(self.exception),
+                                                    None, 0, 0))
+                return
+
             self.terminate()
 
     def start(self):
@@ -547,13 +1785,20 @@ class Spider:
         happen:
 
          * Set the running flag
-         * Create an :class:`pathspider.observer.Observer` and start its
-           process
+         * Create :attr:`observer_count` instances of
+           :class:`pathspider.observer.Observer`, each handling one partition
+           of the flows, and start their processes
+         * With more than one :attr:`worker_group_count`, fork the worker
+           processes, each running a share of the workers
          * Start the merger thread
-         * Start the configurator thread
-         * Start the worker threads
-
-        The number of worker threads to start was given when activating the
+         * Start the configurator thread, unless in barrier-free mode
+         * Start exporting configurator metrics, if :attr:`metrics_file` is
+           set
+         * Start the worker threads, or for the "asyncio" :attr:`engine`, a
+           thread running the workers as coroutines; or with worker
+           processes, threads passing jobs and results to and from them
+
+        The number of workers to start was given when activating the
         plugin.
         """
 
@@ -564,21 +1809,65 @@ class Spider:
 
         logger.info("starting pathspider")
 
+        if self.barrier_free and not self.per_socket_config:
+            logger.error("plugin cannot run barrier-free: "
+                         "no per-socket configuration")
+            sys.exit(1)
+
+        if self.source_port_base is not None:
+            (low, high) = self.source_port_range()
+            if not (0 < low and high <= 65536):
+                logger.error("source ports %u to %u are out of range" %
+                             (low, high - 1))
+                sys.exit(1)
+
         with self.lock:
             # set the running flag
             self.running = True
+            self.config_metrics = ConfiguratorMetrics()
+            self.job_tracker = JobTracker()
+
+            # only filter flows by source port when the plugin binds all
+            # its connections to them
+            self._port_filter_bypass = None
+            if self.source_port_base is not None:
+                if self.binds_source_ports:
+                    self._port_filter_bypass = mp.RawValue('b', 0)
+                else:
+                    logger.info("plugin does not bind all of its "
+                                "connections to source ports, observers "
+                                "track flows on all ports")
+
+            # create observers and start their processes
+            self.observers = []
+            self.observer_processes = []
+            for i in range(self.observer_count):
+                observer = self.create_observer()
+                observer.set_shard(i, self.observer_count)
+                if self._port_filter_bypass is not None:
+                    observer.set_port_range(*self.source_port_range(),
+                                            bypass=self._port_filter_bypass)
+                if self.observer_compact_records:
+                    observer.use_compact_records()
+                if self.observer_profile:
+                    observer.enable_profiling()
+                observer_process = mp.Process(
+                    args=(observer.run_flow_enqueuer,
+                          self.flowqueue, 
+                          self.observer_shutdown_queue,
+                          self.flow_batch_size,
+                          self.flow_batch_delay),
+                    target=self.exception_wrapper,
+                    name='observer_{}'.format(i),
+                    daemon=True)
+                self.observers.append(observer)
+                self.observer_processes.append(observer_process)
+                observer_process.start()
+            logger.debug("observers forked")
 
-            # create an observer and start its process
-            self.observer = self.create_observer()
-            self.observer_process = mp.Process(
-                args=(self.observer.run_flow_enqueuer,
-                      self.flowqueue, 
-                      self.observer_shutdown_queue),
-                target=self.exception_wrapper,
-                name='observer',
-                daemon=True)
-            self.observer_process.start()
-            logger.debug("observer forked")
+            if self.worker_group_count > 1:
+                self._start_worker_groups()
+                logger.debug("worker groups forked")
 
             # now start up ecnspider, backwards
             self.merger_thread = threading.Thread(
@@ -589,13 +1878,23 @@ class Spider:
             self.merger_thread.start()
             logger.debug("merger up")
 
-            self.configurator_thread = threading.Thread(
-                args=(self.configurator,),
-                target=self.exception_wrapper,
-                name="configurator",
-                daemon=True)
-            self.configurator_thread.start()
-            logger.debug("configurator up")
+            if self.barrier_free:
+                logger.debug("barrier-free, not starting configurator")
+            else:
+                self.configurator_thread = threading.Thread(
+                    args=(self.configurator,),
+                    target=self.exception_wrapper,
+                    name="configurator",
+                    daemon=True)
+                self.configurator_thread.start()
+                logger.debug("configurator up")
+
+            if self.metrics_file is not None:
+                self.metrics_exporter = MetricsExporter(
+                        self, self.metrics_file, self.metrics_format,
+                        self.metrics_interval)
+                self.metrics_exporter.start()
+                logger.debug("metrics exporter up")
 
             # threading.Thread(
             #     target = self.worker_status_reporter,
@@ -606,14 +1905,18 @@ class Spider:
             self.worker_threads = []
             with self.active_worker_lock:
                 self.active_worker_count = self.worker_count
-            for i in range(self.worker_count):
-                worker_thread = threading.Thread(
-                    args=(self.worker, i),
-                    target=self.exception_wrapper,
-                    name='worker_{}'.format(i),
-                    daemon=True)
-                self.worker_threads.append(worker_thread)
-                worker_thread.start()
+            if self.worker_group_count > 1:
+                for target in (self._forward_group_jobs,
+                               self._forward_group_results):
+                    forwarder_thread = threading.Thread(
+                        args=(target,),
+                        target=self.exception_wrapper,
+                        name=target.__name__.lstrip('_'),
+                        daemon=True)
+                    self.worker_threads.append(forwarder_thread)
+                    forwarder_thread.start()
+            else:
+                self._start_workers()
             logger.debug("workers up")
 
             # if self.check_interrupt is not None:
@@ -625,6 +1928,138 @@ class Spider:
             #     self.interrupter_thread.start()
             #     logger.debug("interrupter up")
 
+    def _start_workers(self):
+        """
+        Start the worker threads, or the thread running the workers as
+        coroutines, adding them to :attr:`worker_threads`.
+        """
+        if self.engine == ENGINE_ASYNCIO:
+            worker_thread = threading.Thread(
+                args=(self.async_engine,),
+                target=self.exception_wrapper,
+                name='async_engine',
+                daemon=True)
+            self.worker_threads.append(worker_thread)
+            worker_thread.start()
+        else:
+            for i in range(self.worker_count):
+                worker_thread = threading.Thread(
+                    args=(self.worker, self.worker_offset + i),
+                    target=self.exception_wrapper,
+                    name='worker_{}'.format(i),
+                    daemon=True)
+                self.worker_threads.append(worker_thread)
+                worker_thread.start()
+
+    def _start_worker_groups(self):
+        """
+        Fork the worker processes, sharing the configurator state with them.
+        This must happen before any other threads are started.
+        """
+        self.config_barrier.share()
+        self._group_jobqueue = mp.JoinableQueue(QUEUE_SIZE)
+        self._group_resqueue = mp.Queue(QUEUE_SIZE)
+
+        self.worker_group_processes = []
+        offset = 0
+        for group in range(self.worker_group_count):
+            # divide the workers as evenly as possible
+            count = self.worker_count // self.worker_group_count
+            if group < self.worker_count % self.worker_group_count:
+                count += 1
+
+            group_process = mp.Process(
+                args=(self.run_worker_group, group, count, offset),
+                target=self.exception_wrapper,
+                name='worker_group_{}'.format(group),
+                daemon=True)
+            self.worker_group_processes.append(group_process)
+            group_process.start()
+            offset += count
+
+    def run_worker_group(self, group, worker_count, worker_offset=0):
+        """
+        Run ``worker_count`` of the workers in a worker process, numbered
+        from ``worker_offset``.
+
+        The workers take jobs from a queue fed by the job forwarder thread of
+        the parent process, and put their results on a queue emptied by the
+        result forwarder thread, which passes them on to the merger. When all
+        the workers have shut down, the number of jobs completed, the time
+        the workers waited for the configurator and the numbers of
+        connections which could not bind their source port or were made
+        again for it are passed back to the parent.
+        """
+        self.worker_group = group
+        self.worker_count = worker_count
+        self.worker_offset = worker_offset
+        self.jobqueue = self._group_jobqueue
+        self.worker_threads = []
+        # only count what the workers of this process record
+        self.config_metrics = ConfiguratorMetrics()
+        self.ct_source_port_fallbacks = 0
+        self.ct_source_port_clashes = 0
+        self._start_workers()
+
+        for worker in self.worker_threads:
+            worker.join()
+
+        self._group_resqueue.put(_GroupDone(
+                group, worker_count, self.jobs_completed, None,
+                self.config_metrics.wait_seconds,
+                self.ct_source_port_fallbacks, self.ct_source_port_clashes))
+
+    def _forward_group_jobs(self):
+        """
+        Pass jobs from the job queue to the worker processes, until each
+        worker has been passed a shutdown sentinel or the spider stops.
+        """
+        sentinels = 0
+        while self.running and sentinels < self.worker_count:
+            try:
+                job = self.jobqueue.get(timeout=QUEUE_SLEEP)
+            except queue.Empty:
+                continue
+
+            self._group_jobqueue.put(job)
+            self.jobqueue.task_done()
+            if job == SHUTDOWN_SENTINEL:
+                sentinels += 1
+
+    def _forward_group_results(self):
+        """
+        Pass results from the worker processes to the merger, until all of
+        the worker processes have finished or the spider stops.
+        """
+        logger = logging.getLogger('pathspider')
+
+        groups = self.worker_group_count
+        while self.running and groups > 0:
+            try:
+                res = self._group_resqueue.get(timeout=QUEUE_SLEEP)
+            except queue.Empty:
+                continue
+
+            if not isinstance(res, _GroupDone):
+                self._queue_result(res)
+                continue
+
+            if res.error is not None:
+                raise RuntimeError("worker group " + str(res.group) +
+                                   " failed: " + res.error)
+
+            logger.debug("worker group " + str(res.group) + " shut down")
+            groups -= 1
+            self.config_metrics.merge_waits(res.wait_seconds)
+            with self.active_worker_lock:
+                self.active_worker_count -= res.workers
+                self.jobs_completed += res.jobs
+                self.ct_source_port_fallbacks += res.source_port_fallbacks
+                self.ct_source_port_clashes += res.source_port_clashes
+
+        for group_process in self.worker_group_processes:
+            group_process.join()
+
     def shutdown(self):
         """
         Shut down PathSpider in an orderly fashion, 
@@ -635,6 +2070,10 @@ class Spider:
         logger = logging.getLogger('pathspider')
 
         logger.info("shutting down pathspider")
+
+        if not self.running:
+            logger.error("pathspider was terminated, not shutting down")
+            return
         
         with self.lock:
             # Set stopping flag
@@ -651,17 +2090,36 @@ class Spider:
                     logger.debug("joining worker: " + repr(worker))
                     worker.join()
             logger.debug("all workers joined")            
-
-            # Tell observer to shut down
-            self.observer_shutdown_queue.put(True)
-            self.observer_process.join()
-            logger.debug("observer shutdown")
+            self._log_config_stats()
+            if self.ct_source_port_fallbacks:
+                logger.info("%u connections could not bind their source "
+                            "port" % self.ct_source_port_fallbacks)
+            if self.ct_source_port_clashes:
+                logger.info("%u connections were made again, their source "
+                            "port being in TIME_WAIT" %
+                            self.ct_source_port_clashes)
+            if self.metrics_exporter is not None:
+                self.metrics_exporter.stop()
+
+            # Tell observers to shut down
+            for observer_process in self.observer_processes:
+                self.observer_shutdown_queue.put(True)
+            for observer_process in self.observer_processes:
+                observer_process.join()
+            logger.debug("observers shutdown")
 
             # Tell merger to shut down
-            self.resqueue.put(SHUTDOWN_SENTINEL)
+            self._queue_result(SHUTDOWN_SENTINEL)
             self.merger_thread.join()
             logger.debug("merger shutdown")
 
+            if not self.running:
+                # the merger failed and terminated the spider, which has
+                # already told the output loop to stop
+                logger.error("pathspider was terminated while shutting "
+                             "down")
+                return
+
             # Wait for merged results to be written
             self.outqueue.join()
             logger.debug("all results retrieved")
@@ -671,6 +2129,7 @@ class Spider:
 
             # Tell threads we've stopped
             self.running = False
+            self.config_barrier.stop()
 
             # Join configurator
             # if threading.current_thread() != self.configurator_thread:
@@ -692,11 +2151,23 @@ class Spider:
         # tell threads to stop
         self.stopping = True
         self.running = False
+        self.config_barrier.stop()
+
+        # terminate observers
+        for observer_process in self.observer_processes:
+            self.observer_shutdown_queue.put(True)
 
-        # terminate observer
-        self.observer_shutdown_queue.put(True)
+        # terminate worker processes
+        for group_process in self.worker_group_processes:
+            group_process.terminate()
 
-        # drain queues
+        # drain queues, discarding queued jobs so that nothing waits to
+        # add another
+        try:
+            while True:
+                self.jobqueue.get_nowait()
+        except queue.Empty:
+            pass
         try:
             while True:
                 self.jobqueue.task_done()
@@ -722,7 +2193,8 @@ class Spider:
                 worker.join()
         logger.debug("all workers joined")           
 
-        if threading.current_thread() != self.configurator_thread:
+        if (self.configurator_thread is not None and
+                threading.current_thread() != self.configurator_thread):
             self.configurator_thread.join()
         logger.debug("configurator joined")           
         
@@ -730,8 +2202,12 @@ class Spider:
             self.merger_thread.join() 
         logger.debug("merger joined")           
 
-        self.observer_process.join()
-        logger.debug("observer joined")
+        for observer_process in self.observer_processes:
+            observer_process.join()
+        logger.debug("observers joined")
+
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
 
         self.outqueue.put(SHUTDOWN_SENTINEL)
         logger.info("termination complete")
@@ -741,12 +2217,23 @@ class Spider:
         Adds a job to the job queue.
 
         If PATHspider is currently stopping, the job will not be added to the
-        queue.
+        queue. Jobs which are lists are numbered, unless they have been
+        numbered already by the job feeder, by making them a :class:`Job`;
+        the number is carried with the job's results to the merger, and
+        numbered jobs are tracked for checkpoints.
         """
 
         if self.stopping:
             return
 
+        jobid = getattr(job, 'jobid', None)
+        if jobid is None and isinstance(job, list):
+            jobid = next(self._job_ids)
+            job = Job(job, jobid)
+
+        if jobid is not None and self.checkpoint_interval is not None:
+            self.job_tracker.add(jobid)
+
         self.jobqueue.put(job)
 
 # def local_address(ipv=4, target="path-ams.corvid.ch", port=53):
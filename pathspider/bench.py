@@ -0,0 +1,864 @@
+"""
+Microbenchmarks for PATHspider internals.
+
+These are used for performance evaluation and regression checking of the
+hot paths in the Observer and the Spider, and do not check for correctness.
+Run a benchmark with::
+
+    python3 -m pathspider.bench <name> [args...]
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import heapq
+import base64
+import socket
+import hashlib
+import tempfile
+import subprocess
+import threading
+import collections
+import tracemalloc
+import multiprocessing as mp
+
+from pathspider.base import Spider
+from pathspider.base import PhaseBarrier
+from pathspider.base import SHUTDOWN_SENTINEL
+from pathspider.observer import _flow4_key
+from pathspider.observer import _flow6_key
+from pathspider.observer.record import chain_fields
+from pathspider.observer.record import compact_record_type
+from pathspider.observer.timer import PacketClockTimerQueue
+
+def bench_timer_queue(pending=100000, packets=1000000, rate=10000.0):
+    """
+    Replay a synthetic packet clock against a timer queue holding
+    ``pending`` timers and report the per-packet cost of advancing the
+    clock.
+
+    Packets arrive at ``rate`` packets per second of packet clock. Every
+    timer fired is replaced by a new one 5 seconds in the future (as for
+    flow expiry), so the queue stays at ``pending`` timers throughout.
+    """
+    pending = int(pending)
+    packets = int(packets)
+    rate = float(rate)
+
+    rng = random.Random(0)
+    tq = PacketClockTimerQueue()
+    fired = [0]
+
+    def fn():
+        fired[0] += 1
+        tq.schedule(pt + 5, fn)
+
+    span = pending / rate
+    for _ in range(pending):
+        tq.schedule(rng.uniform(0, span), fn)
+
+    pt = 0.0
+    step = 1.0 / rate
+    start = time.perf_counter()
+    for _ in range(packets):
+        pt += step
+        for f in tq.expired(pt):
+            f()
+    elapsed = time.perf_counter() - start
+
+    print("timer queue: %u pending, %u packets, %u fired: %.0f ns/packet" %
+          (len(tq), packets, fired[0], elapsed / packets * 1e9))
+
+    # the previous implementation scanned the whole heap with min() on
+    # every packet; run it over far fewer packets for comparison.
+    legacy = [(rng.uniform(0, span), i) for i in range(pending)]
+    heapq.heapify(legacy)
+    legacy_packets = max(1, packets // 1000)
+    pt = 0.0
+    start = time.perf_counter()
+    for _ in range(legacy_packets):
+        pt += step
+        while len(legacy) > 0 and pt > min(legacy, key=lambda x: x[0])[0]:
+            (_, i) = heapq.heappop(legacy)
+            heapq.heappush(legacy, (pt + 5, i))
+    elapsed = time.perf_counter() - start
+
+    print("min() scan:  %u pending, %u packets: %.0f ns/packet" %
+          (len(legacy), legacy_packets, elapsed / legacy_packets * 1e9))
+
+def _synthetic_flow(i):
+    return {'sip': "10.0.0.1", 'dip': "192.0.2.%u" % (i % 256),
+            'proto': 6, 'sp': 32768 + i % 28000, 'dp': 80,
+            'pkt_fwd': 5, 'pkt_rev': 4, 'oct_fwd': 420, 'oct_rev': 3000,
+            'fwd_fin': True, 'rev_fin': True, 'fwd_rst': False,
+            'rev_rst': False, 'first': 1e9 + i, 'last': 1e9 + i + 0.2}
+
+def _flow_producer(flowqueue, flows, batch_size):
+    batch = []
+    for i in range(flows):
+        if batch_size <= 1:
+            flowqueue.put(_synthetic_flow(i))
+        else:
+            batch.append(_synthetic_flow(i))
+            if len(batch) >= batch_size:
+                flowqueue.put(batch)
+                batch = []
+    if batch:
+        flowqueue.put(batch)
+    flowqueue.put(None)
+
+def bench_flow_transfer(flows=200000, batch_sizes="1,10,100,1000"):
+    """
+    Pass ``flows`` synthetic flow records from a child process to this one
+    over a multiprocessing queue, as the observer does, and report flows per
+    second received for each batch size.
+    """
+    flows = int(flows)
+
+    for batch_size in [int(b) for b in str(batch_sizes).split(",")]:
+        flowqueue = mp.Queue(1000)
+        producer = mp.Process(target=_flow_producer,
+                              args=(flowqueue, flows, batch_size))
+
+        start = time.perf_counter()
+        producer.start()
+        received = 0
+        while True:
+            item = flowqueue.get()
+            if item is None:
+                break
+            received += len(item) if isinstance(item, list) else 1
+        elapsed = time.perf_counter() - start
+        producer.join()
+
+        print("flow transfer: batch size %5u: %u flows, %.0f flows/s" %
+              (batch_size, received, received / elapsed))
+
+def _legacy_flow4_ids(ip):
+    if ip.proto == 6 or ip.proto == 17 or ip.proto == 132:
+        fid = ip.src_prefix.addr + ip.dst_prefix.addr + ip.data[9:10] + ip.payload[0:4]
+        rid = ip.dst_prefix.addr + ip.src_prefix.addr + ip.data[9:10] + ip.payload[2:4] + ip.payload[0:2]
+    else:
+        fid = ip.src_prefix.addr + ip.dst_prefix.addr + ip.data[9:10]
+        rid = ip.dst_prefix.addr + ip.src_prefix.addr + ip.data[9:10]
+    return (base64.b64encode(fid), base64.b64encode(rid))
+
+def _legacy_flow6_ids(ip6):
+    if ip6.proto == 6 or ip6.proto == 17 or ip6.proto == 132:
+        fid = ip6.src_prefix.addr + ip6.dst_prefix.addr + ip6.data[6:7] + ip6.payload[0:4]
+        rid = ip6.dst_prefix.addr + ip6.src_prefix.addr + ip6.data[6:7] + ip6.payload[2:4] + ip6.payload[0:2]
+    else:
+        fid = ip6.src_prefix.addr + ip6.dst_prefix.addr + ip6.data[6:7]
+        rid = ip6.dst_prefix.addr + ip6.src_prefix.addr + ip6.data[6:7]
+    return (base64.b64encode(fid), base64.b64encode(rid))
+
+def _legacy_lookup(ignored, active, expiring, ffid, rfid):
+    if ffid in ignored or rfid in ignored:
+        return None
+    return (active.get(ffid) or expiring.get(ffid) or
+            active.get(rfid) or expiring.get(rfid))
+
+def _flow_key_pass(pcap, keyfn):
+    import plt as libtrace
+
+    trace = libtrace.trace("pcapfile:" + pcap)
+    trace.start()
+    pkt = libtrace.packet()
+    packets = 0
+    start = time.perf_counter()
+    while trace.read_packet(pkt):
+        packets += 1
+        if keyfn is not None:
+            keyfn(pkt)
+    return (packets, time.perf_counter() - start)
+
+def bench_flow_keys(pcap):
+    """
+    Compute flow keys and look up flows for every packet in a pcap file,
+    and report the per-packet cost of the base64 forward/reverse IDs used
+    previously and of the canonical flow keys used now.
+
+    Each is measured as a separate pass over the file, less the time for a
+    pass which only reads the packets.
+    """
+    legacy = {}
+    def legacy_keyfn(pkt):
+        try:
+            if pkt.ip:
+                (ffid, rfid) = _legacy_flow4_ids(pkt.ip)
+            elif pkt.ip6:
+                (ffid, rfid) = _legacy_flow6_ids(pkt.ip6)
+            else:
+                return
+        except ValueError:
+            return
+        if _legacy_lookup((), legacy, {}, ffid, rfid) is None:
+            legacy[ffid] = True
+
+    flows = {}
+    def keyfn(pkt):
+        try:
+            if pkt.ip:
+                (key, _) = _flow4_key(pkt.ip)
+            elif pkt.ip6:
+                (key, _) = _flow6_key(pkt.ip6)
+            else:
+                return
+        except ValueError:
+            return
+        if flows.get(key, False) is False:
+            flows[key] = True
+
+    (packets, base) = _flow_key_pass(pcap, None)
+    (_, legacy_elapsed) = _flow_key_pass(pcap, legacy_keyfn)
+    (_, elapsed) = _flow_key_pass(pcap, keyfn)
+
+    print("flow keys: %u packets, %u flows (%u by base64 ids)" %
+          (packets, len(flows), len(legacy)))
+    print("base64 ids:     %.0f ns/packet" %
+          ((legacy_elapsed - base) / packets * 1e9))
+    print("canonical keys: %.0f ns/packet" % ((elapsed - base) / packets * 1e9))
+
+def _ecn_chains():
+    from pathspider.observer import basic_flow
+    from pathspider.observer.tcp import tcp_setup
+    from pathspider.plugins.ecnspider3 import ecnsetup
+    from pathspider.plugins.ecnspider3 import ecnflags
+
+    return ([basic_flow, tcp_setup, ecnsetup], [ecnflags])
+
+def _fill_records(record_type, flows):
+    records = []
+    for i in range(flows):
+        rec = record_type()
+        for (field, value) in _synthetic_flow(i).items():
+            rec[field] = value
+        for field in ('ecn_zero', 'ecn_one', 'ce'):
+            rec[field] = False
+        rec['fwd_syn_flags'] = 0x02
+        rec['rev_syn_flags'] = 0x12
+        records.append(rec)
+    return records
+
+def bench_flow_records(flows=100000):
+    """
+    Create ``flows`` flow records with the fields used by ECNSpider, both as
+    dicts and as compact records, and report the memory used per flow and
+    the time taken per counter update.
+    """
+    flows = int(flows)
+    fields = chain_fields(*_ecn_chains())
+
+    for (name, record_type) in (("dict", dict),
+                                ("compact", compact_record_type(fields))):
+        tracemalloc.start()
+        records = _fill_records(record_type, flows)
+        (size, _) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        for rec in records:
+            rec['pkt_fwd'] += 1
+            rec['oct_fwd'] += 1500
+        elapsed = time.perf_counter() - start
+
+        print("%-8s records: %u flows, %.0f bytes/flow, %.0f ns/update" %
+              (name, flows, size / flows, elapsed / flows / 2 * 1e9))
+        del records
+
+class _FakeHeader:
+    def __init__(self):
+        self.size = 1500
+        self.traffic_class = 0x02
+        self.flags = 0x10
+        self.fin_flag = False
+        self.rst_flag = False
+
+class _FakePacket:
+    """
+    Packet whose header properties build a new object on each access, as
+    python-libtrace's do.
+    """
+    @property
+    def ip(self):
+        return _FakeHeader()
+
+    @property
+    def ip6(self):
+        return None
+
+    @property
+    def tcp(self):
+        return _FakeHeader()
+
+    @property
+    def udp(self):
+        return None
+
+def _legacy_dispatch(pkt, rec, rev, ip4_chain, ip6_chain, tcp_chain,
+                     udp_chain, l4_chain):
+    keep_flow = True
+
+    if pkt.ip:
+        for fn in ip4_chain:
+            keep_flow = keep_flow and fn(rec, pkt.ip, rev=rev)
+    elif pkt.ip6:
+        for fn in ip6_chain:
+            keep_flow = keep_flow and fn(rec, pkt.ip6, rev=rev)
+
+    if pkt.tcp:
+        for fn in tcp_chain:
+            keep_flow = keep_flow and fn(rec, pkt.tcp, rev=rev)
+    elif pkt.udp:
+        for fn in udp_chain:
+            keep_flow = keep_flow and fn(rec, pkt.udp, rev=rev)
+    else:
+        for fn in l4_chain:
+            keep_flow = keep_flow and fn(rec, pkt, rev=rev)
+
+    return keep_flow
+
+def bench_chain_dispatch(packets=200000):
+    """
+    Run ECNSpider's packet chains over ``packets`` synthetic TCP/IPv4
+    packets, and report the per-packet cost of the chain loops used
+    previously and of the compiled dispatcher used now.
+    """
+    from pathspider.observer import basic_count
+    from pathspider.observer import compile_dispatch
+    from pathspider.observer.tcp import tcp_complete
+    from pathspider.plugins.ecnspider3 import ecncode
+    from pathspider.plugins.ecnspider3 import ecnflags
+
+    packets = int(packets)
+    chains = ([basic_count, ecncode], [basic_count, ecncode],
+              [ecnflags, tcp_complete], [], [])
+    pkt = _FakePacket()
+
+    for (name, short_circuit) in (("legacy", None),
+                                  ("short-circuit", True),
+                                  ("all-functions", False)):
+        rec = dict(_synthetic_flow(0), fwd_fin=False, rev_fin=False,
+                   ecn_zero=False, ecn_one=False, ce=False)
+        if short_circuit is None:
+            start = time.perf_counter()
+            for i in range(packets):
+                _legacy_dispatch(pkt, rec, False, *chains)
+        else:
+            dispatch = compile_dispatch(*chains, short_circuit=short_circuit)
+            start = time.perf_counter()
+            for i in range(packets):
+                ip = pkt.ip
+                dispatch(rec, pkt, ip, None if ip else pkt.ip6, False)
+        elapsed = time.perf_counter() - start
+
+        print("%-14s chain dispatch: %.0f ns/packet" %
+              (name, elapsed / packets * 1e9))
+
+class _NullObserver:
+    """
+    Observer which sees no flows, for benchmarking the Spider without
+    capturing packets.
+    """
+    def set_shard(self, shard, shard_count):
+        pass
+
+    def run_flow_enqueuer(self, flowqueue, irqueue=None, *args):
+        if irqueue is not None:
+            irqueue.get()
+        flowqueue.put(SHUTDOWN_SENTINEL)
+
+_BenchRecord = collections.namedtuple("_BenchRecord",
+                                      ["ip", "rport", "port", "config"])
+
+class _BenchSpider(Spider):
+    """
+    Spider whose connections and configuration changes just take a fixed
+    time, which records configuration changes and job latencies (from
+    add_job to the end of the job).
+    """
+    def __init__(self, worker_count, connect_time=0.0, config_time=0.0):
+        super().__init__(worker_count=worker_count, libtrace_uri=None)
+        self.connect_time = connect_time
+        self.config_time = config_time
+        # draw connection times from an exponential distribution
+        self.connect_jitter = False
+        self.flips = 0
+        self.latencies = []
+
+    def config_zero(self):
+        self.flips += 1
+        time.sleep(self.config_time)
+
+    def config_one(self):
+        self.flips += 1
+        time.sleep(self.config_time)
+
+    def connect(self, job, pcs, config):
+        if self.connect_jitter:
+            time.sleep(random.expovariate(1 / self.connect_time))
+        else:
+            time.sleep(self.connect_time)
+
+    def configure_socket(self, sock, config):
+        pass
+
+    def post_connect(self, job, conn, pcs, config):
+        if config == 1:
+            self.latencies.append(time.monotonic() - job[2])
+        return _BenchRecord(job[0], job[1], 0, config)
+
+    def create_observer(self):
+        return _NullObserver()
+
+    def merge(self, flow, res):
+        pass
+
+    def add_job(self, job):
+        super().add_job([job[0], job[1], time.monotonic()])
+
+def _run_bench_spider(spider, jobs, rate=None):
+    """
+    Run ``jobs`` jobs through a benchmark spider, at ``rate`` jobs per
+    second or as fast as possible, and return the time taken.
+    """
+    start = time.monotonic()
+    spider.start()
+    for i in range(jobs):
+        if rate:
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        spider.add_job(["192.0.2.%u" % (i % 256), 10000 + i])
+
+    # collect results as run.py would
+    shutdown = threading.Thread(target=spider.shutdown)
+    shutdown.start()
+    while spider.outqueue.get() != SHUTDOWN_SENTINEL:
+        spider.outqueue.task_done()
+    shutdown.join()
+    if spider.exception is not None:
+        raise RuntimeError("benchmark spider failed") from spider.exception
+    return time.monotonic() - start
+
+def _latency_report(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return "no jobs"
+    return "job latency median %.1f ms, p99 %.1f ms, max %.1f ms" % (
+        latencies[len(latencies) // 2] * 1e3,
+        latencies[int(len(latencies) * 0.99)] * 1e3,
+        latencies[-1] * 1e3)
+
+def bench_config_flips(jobs=500, rate=100.0, workers=100, connect_time=0.005,
+                       batch=1):
+    """
+    Feed ``jobs`` jobs at ``rate`` jobs per second to a spider with
+    ``workers`` workers whose connections take ``connect_time`` seconds,
+    then the same number as fast as possible, and report configuration
+    changes per second and job latency. ``batch`` sets the job batch size
+    of the spider.
+    """
+    jobs = int(jobs)
+
+    for (name, feed_rate) in (("trickle", float(rate)), ("flood", None)):
+        spider = _BenchSpider(int(workers), connect_time=float(connect_time))
+        spider.job_batch_size = int(batch)
+        elapsed = _run_bench_spider(spider, jobs, feed_rate)
+        print("%-8s %u jobs in %.2f s: %u config changes (%.1f/s, "
+              "%.1f per 1000 jobs), %s" %
+              (name, jobs, elapsed, spider.flips, spider.flips / elapsed,
+               spider.flips * 1000 / jobs, _latency_report(spider.latencies)))
+
+class _LoopbackSpider(_BenchSpider):
+    """
+    Spider which makes real TCP connections to a listener on the loopback
+    interface, and spends ``work`` rounds of hashing on each result to stand
+    in for the CPU time of post-connection processing.
+    """
+    def __init__(self, worker_count, address, work=0):
+        super().__init__(worker_count)
+        self.address = address
+        self.work = work
+
+    def connect(self, job, pcs, config):
+        return socket.create_connection(self.address)
+
+    def post_connect(self, job, conn, pcs, config):
+        port = conn.getsockname()[1]
+        conn.close()
+        digest = b""
+        for i in range(self.work):
+            digest = hashlib.sha1(digest).digest()
+        return _BenchRecord(job[0], job[1], port, config)
+
+def _loopback_listener():
+    """
+    Listen on the loopback interface, accepting and closing connections in
+    a thread. Returns the listening address.
+    """
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1024)
+
+    def accept():
+        while True:
+            (conn, _) = listener.accept()
+            conn.close()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()
+
+def bench_worker_groups(jobs=2000, workers=64, work=200, groups="1,2,4,8"):
+    """
+    Run ``jobs`` jobs against a loopback target with ``workers`` workers,
+    divided between each of the given numbers of worker processes, and
+    report jobs per second.
+    """
+    jobs = int(jobs)
+    address = _loopback_listener()
+
+    for group_count in [int(g) for g in groups.split(",")]:
+        spider = _LoopbackSpider(int(workers), address, work=int(work))
+        spider.worker_group_count = group_count
+        elapsed = _run_bench_spider(spider, jobs)
+        print("%u worker processes: %u jobs in %.2f s, %.0f jobs/s, "
+              "%u config changes" %
+              (group_count, jobs, elapsed, jobs / elapsed, spider.flips))
+
+def bench_sysctl_write(rounds=200, path=None):
+    """
+    Time ECNSpider configuration changes writing the tcp_ecn sysctl through
+    its cached file handle, against spawning a process for each change as
+    running sysctl does. Writes to ``path``, which defaults to a temporary
+    file standing in for the file in /proc.
+    """
+    from pathspider.plugins.ecnspider3 import ECNSpider
+
+    rounds = int(rounds)
+    if path is None:
+        (fd, path) = tempfile.mkstemp()
+        os.write(fd, b"0\n")
+        os.close(fd)
+
+    spider = ECNSpider(0, None)
+    spider.tcp_ecn_path = path
+    start = time.perf_counter()
+    for i in range(rounds):
+        spider.config_zero()
+        spider.config_one()
+    file_time = time.perf_counter() - start
+    if spider.tcp_ecn_file is False:
+        print("could not write %s, timed sysctl instead" % path)
+
+    start = time.perf_counter()
+    for i in range(rounds):
+        for value in (2, 1):
+            subprocess.check_call(["/bin/sh", "-c",
+                                   "echo %u > %s" % (value, path)])
+    spawn_time = time.perf_counter() - start
+
+    print("file handle: %.1f us/change" % (file_time * 1e6 / (rounds * 2)))
+    print("spawn:       %.1f us/change" % (spawn_time * 1e6 / (rounds * 2)))
+
+def bench_barrier_free(jobs=2000, workers=100, connect_time=0.01,
+                       config_time=0.001):
+    """
+    Run ``jobs`` jobs with ``workers`` workers, with and without the
+    configurator barrier, and report jobs per second. Connection times are
+    exponentially distributed with mean ``connect_time`` seconds, and each
+    configuration change takes ``config_time`` seconds.
+    """
+    jobs = int(jobs)
+
+    for barrier_free in (False, True):
+        spider = _BenchSpider(int(workers), connect_time=float(connect_time),
+                              config_time=float(config_time))
+        spider.connect_jitter = True
+        spider.per_socket_config = True
+        spider.barrier_free = barrier_free
+        elapsed = _run_bench_spider(spider, jobs)
+        print("%-12s %u jobs in %.2f s, %.0f jobs/s, %u config changes, %s" %
+              ("barrier-free" if barrier_free else "barrier", jobs, elapsed,
+               jobs / elapsed, spider.flips, _latency_report(spider.latencies)))
+
+def bench_dscp_flips(rounds=50, bindir=None):
+    """
+    Time DSCPSpider configuration changes, running the iptables commands in
+    ``bindir`` (such as fakes which just log their input), or from the PATH.
+    """
+    from pathspider.plugins.dscpspider import DSCPSpider
+
+    rounds = int(rounds)
+    spider = DSCPSpider(0, None)
+    if bindir is not None:
+        spider.iptables_commands = [
+            tuple(os.path.join(bindir, command) for command in commands)
+            for commands in spider.iptables_commands]
+
+    # the first change creates the chain
+    spider.config_zero()
+
+    times = []
+    for i in range(rounds):
+        for config in (spider.config_one, spider.config_zero):
+            start = time.perf_counter()
+            config()
+            times.append(time.perf_counter() - start)
+
+    times.sort()
+    print("%u changes: median %.2f ms, max %.2f ms" %
+          (len(times), times[len(times) // 2] * 1e3, times[-1] * 1e3))
+
+class _TokenSemaphore(threading.BoundedSemaphore):
+    """
+    The semaphore the configurator used to synchronise with the workers
+    before PhaseBarrier, handling n tokens by looping.
+    """
+    def __init__(self, value):
+        super().__init__(value)
+        while self.acquire(blocking=False):
+            pass
+
+    def acquire_n(self, value):
+        for _ in range(value):
+            self.acquire()
+
+    def release_n(self, value):
+        for _ in range(value):
+            self.release()
+
+def _run_phase_threads(workers, worker, configurator):
+    """
+    Start ``workers`` threads running ``worker`` and one running
+    ``configurator``, release them together, and return the time taken for
+    the workers to finish.
+    """
+    go = threading.Event()
+    def wait_and_run(fn):
+        go.wait()
+        fn()
+
+    threads = [threading.Thread(target=wait_and_run, args=(worker,))
+               for i in range(workers)]
+    config_thread = threading.Thread(target=wait_and_run,
+                                     args=(configurator,), daemon=True)
+    for thread in threads + [config_thread]:
+        thread.start()
+
+    start = time.perf_counter()
+    go.set()
+    for thread in threads:
+        thread.join()
+    return (time.perf_counter() - start, config_thread)
+
+def _token_phases(workers, cycles):
+    sem_zero = _TokenSemaphore(workers)
+    sem_zero_rdy = _TokenSemaphore(workers)
+    sem_one = _TokenSemaphore(workers)
+    sem_one_rdy = _TokenSemaphore(workers)
+
+    def configurator():
+        for i in range(cycles):
+            sem_zero.release_n(workers)
+            sem_one_rdy.acquire_n(workers)
+            sem_one.release_n(workers)
+            sem_zero_rdy.acquire_n(workers)
+
+    def worker():
+        for i in range(cycles):
+            sem_zero.acquire()
+            sem_one_rdy.release()
+            sem_one.acquire()
+            sem_zero_rdy.release()
+
+    (elapsed, config_thread) = _run_phase_threads(workers, worker,
+                                                  configurator)
+    config_thread.join()
+    return (elapsed, cycles * 2)
+
+def _barrier_phases(workers, cycles):
+    barrier = PhaseBarrier()
+    phases = [0]
+
+    def configurator():
+        phase = 0
+        while True:
+            phase = barrier.wait_for_demand(phase)
+            if phase is None:
+                break
+            barrier.open(phase)
+            barrier.wait_for_users()
+            barrier.close()
+            phases[0] += 1
+            phase = 1 - phase
+
+    def worker():
+        for i in range(cycles):
+            barrier.enter(0)
+            barrier.leave(0)
+            barrier.enter(1)
+            barrier.leave(1)
+
+    (elapsed, config_thread) = _run_phase_threads(workers, worker,
+                                                  configurator)
+    barrier.stop()
+    config_thread.join()
+    return (elapsed, phases[0])
+
+def bench_phase_barrier(workers="100,1000,5000", cycles=20):
+    """
+    Time cycles of both configuration phases with no work in them, for
+    each of the given numbers of workers, synchronising with the old
+    semaphore token loops and with PhaseBarrier.
+    """
+    cycles = int(cycles)
+
+    for count in [int(w) for w in workers.split(",")]:
+        for (name, run) in (("tokens", _token_phases),
+                            ("barrier", _barrier_phases)):
+            (elapsed, phases) = run(count, cycles)
+            print("%5u workers, %-8s %.2f ms/cycle (%u phases)" %
+                  (count, name, elapsed * 1e3 / cycles, phases))
+
+def _sink_record(i):
+    return {
+        'sip': '192.0.2.1',
+        'dip': '198.51.100.%u' % (i % 256),
+        'dp': 80,
+        'conditions': ['ecn.connectivity.works', 'ecn.negotiated'],
+        'hostname': 'host%u.example.com' % i,
+        'rank': i,
+        'time': {'from': '2016-01-01 00:00:00.000000',
+                 'to': '2016-01-01 00:00:01.000000'},
+    }
+
+def _unbuffered_jsonl(path, records):
+    with open(path, 'w') as outputfile:
+        for record in records:
+            outputfile.write(json.dumps(record) + "\n")
+            outputfile.flush()
+
+def bench_result_sinks(records=200000, batch_size=1000):
+    """
+    Write ``records`` synthetic results with each result sink, and with a
+    write and flush for each record, and report records per second and the
+    size of the output.
+    """
+    from pathspider.sinks import SINKS, open_sink
+
+    records = [_sink_record(i) for i in range(int(records))]
+    tmpdir = tempfile.mkdtemp()
+
+    path = os.path.join(tmpdir, "unbuffered.jsonl")
+    start = time.perf_counter()
+    _unbuffered_jsonl(path, records)
+    elapsed = time.perf_counter() - start
+    print("%-10s %9.0f records/s %7.1f MB" % ("per-record", len(records) /
+          elapsed, os.path.getsize(path) / 1e6))
+    os.unlink(path)
+
+    for format in sorted(SINKS):
+        path = os.path.join(tmpdir, "results." + format)
+        try:
+            start = time.perf_counter()
+            with open_sink(path, format, batch_size=int(batch_size)) as sink:
+                for record in records:
+                    sink.write(record)
+            elapsed = time.perf_counter() - start
+        except ValueError as e:
+            print("%-10s skipped: %s" % (format, e))
+            continue
+        print("%-10s %9.0f records/s %7.1f MB" % (format, len(records) /
+              elapsed, os.path.getsize(path) / 1e6))
+        os.unlink(path)
+
+    os.rmdir(tmpdir)
+
+def _ecn_result(i):
+    flows = []
+    for ecnstate in (0, 1):
+        flows.append({
+            'sip': '192.0.2.1', 'dip': '198.51.100.%u' % (i % 256),
+            'proto': 6, 'sp': 40000 + 2 * (i % 10000) + ecnstate, 'dp': 80,
+            'first': 1451606400.0 + i, 'last': 1451606401.5 + i,
+            'pkt_fwd': 6, 'pkt_rev': 5, 'oct_fwd': 412, 'oct_rev': 1893,
+            'fwd_fin': True, 'fwd_rst': False,
+            'rev_fin': True, 'rev_rst': False,
+            'fwd_syn_flags': 0xc2 if ecnstate else 0x02,
+            'rev_syn_flags': 0x52 if ecnstate else 0x12,
+            'ecn_zero': bool(ecnstate), 'ecn_one': False, 'ce': False,
+            'rank': i, 'host': 'host%u.example.com' % i,
+            'connstate': True, 'ecnstate': ecnstate, 'observed': True,
+            'tstart': '2016-01-01 00:00:00.000000',
+            'tstop': '2016-01-01 00:00:01.000000',
+        })
+    record = _sink_record(i)
+    record['flow_results'] = tuple(flows)
+    return record
+
+def bench_result_encoding(records=50000):
+    """
+    Encode ``records`` synthetic ECNSpider results with json.dumps, as
+    results were written before, and with ResultEncoder with and without
+    ECNSpider's schema and orjson, and report the bytes and CPU time per
+    record.
+    """
+    from pathspider.sinks import ResultEncoder, orjson
+    from pathspider.plugins.ecnspider3 import ECNSpider
+
+    count = int(records)
+    schema = ECNSpider.result_schema
+
+    def dumps_lines(records):
+        return "".join([json.dumps(record) + "\n"
+                        for record in records]).encode("utf-8")
+
+    encoders = [("json.dumps", dumps_lines),
+                ("json", ResultEncoder(None, False).encode_lines),
+                ("json+schema", ResultEncoder(schema, False).encode_lines)]
+    if orjson is None:
+        print("orjson not installed, not timing it")
+    else:
+        encoders += [
+            ("orjson", ResultEncoder(None).encode_lines),
+            ("orjson+schema", ResultEncoder(schema).encode_lines)]
+
+    records = [_ecn_result(i) for i in range(count)]
+    for (name, encode) in encoders:
+        start = time.process_time()
+        data = encode(records)
+        elapsed = time.process_time() - start
+        print("%-14s %6.0f bytes/record %6.2f us/record" %
+              (name, len(data) / count, elapsed * 1e6 / count))
+
+BENCHMARKS = {
+    "timer_queue": bench_timer_queue,
+    "flow_transfer": bench_flow_transfer,
+    "flow_keys": bench_flow_keys,
+    "flow_records": bench_flow_records,
+    "chain_dispatch": bench_chain_dispatch,
+    "config_flips": bench_config_flips,
+    "worker_groups": bench_worker_groups,
+    "sysctl_write": bench_sysctl_write,
+    "barrier_free": bench_barrier_free,
+    "dscp_flips": bench_dscp_flips,
+    "phase_barrier": bench_phase_barrier,
+    "result_sinks": bench_result_sinks,
+    "result_encoding": bench_result_encoding,
+}
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in BENCHMARKS:
+        print("usage: python3 -m pathspider.bench <benchmark> [args...]")
+        print("available benchmarks: " + ", ".join(sorted(BENCHMARKS)))
+        sys.exit(1)
+
+    BENCHMARKS[argv[0]](*argv[1:])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Feeding jobs to a spider from an input file, with checkpoints to resume from.
+
+The job feeder reads the input CSV file row by row, so that the input is
+never held in memory, and numbers each job by its row. The spider's job
+queue is bounded, so the feeder only reads ahead of the workers by as many
+jobs as the queue holds.
+
+When the spider has a ``checkpoint_interval``, the merger puts a
+:class:`pathspider.base.Checkpoint` on the output queue each time all the
+jobs before some row have been merged. Once the output loop has written
+everything ahead of it, it records the row number with
+:func:`write_checkpoint`, and a later run can skip the rows already done
+by passing the number read back with :func:`read_checkpoint` to
+:func:`job_feeder`. Jobs which were in progress when a run stopped are run
+again, so the output may hold more than one record for them.
+
+Input files ending in ``.gz`` are read with gzip, and those ending in
+``.zst`` or ``.zstd`` with the optional zstandard module, decompressing as
+they are read.
+
+"""
+
+import io
+import os
+import csv
+import gzip
+import json
+import logging
+
+from pathspider.base import Job
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def open_input(path):
+    """
+    Open an input file for reading as text, decompressing it as it is read
+    if it is compressed with gzip or zstd.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", newline="")
+
+    if path.endswith((".zst", ".zstd")):
+        if zstandard is None:
+            raise ValueError("reading " + path + " needs the zstandard "
+                             "module")
+        raw = open(path, "rb")
+        reader = zstandard.ZstdDecompressor().stream_reader(
+                raw, read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(reader, newline="")
+
+    return open(path, newline="")
+
+def read_jobs(fp, start=0):
+    """
+    Read jobs from a CSV input file, skipping the first ``start`` rows.
+
+    :returns: generator -- :class:`Job` records, numbered from ``start``.
+    """
+    reader = csv.reader(fp, delimiter=',', quotechar='"')
+    for (jobid, row) in enumerate(reader):
+        if jobid < start:
+            continue
+
+        # port numbers should be integers
+        row[1] = int(row[1])
+
+        yield Job(row, jobid)
+
+def job_feeder(inputfile, spider, start=0):
+    """
+    Add the jobs in an input file to a spider, skipping the first ``start``
+    rows, then shut the spider down.
+    """
+    logger = logging.getLogger('pathspider')
+
+    with open_input(inputfile) as fp:
+        logger.info("job_feeder: started at row %u", start)
+        for job in read_jobs(fp, start):
+            spider.add_job(job)
+
+        logger.info("job_feeder: all jobs added, "
+                    "waiting for spider to finish")
+        spider.shutdown()
+        logger.info("job_feeder: stopped")
+
+def read_checkpoint(path, inputfile):
+    """
+    Read the number of rows of an input file already done from a checkpoint
+    file, or 0 if there is none.
+    """
+    try:
+        with open(path) as fp:
+            checkpoint = json.load(fp)
+    except FileNotFoundError:
+        return 0
+
+    if checkpoint['input'] != inputfile:
+        raise ValueError("checkpoint " + path + " is for input " +
+                         checkpoint['input'] + ", not " + inputfile)
+    return checkpoint['jobs']
+
+def write_checkpoint(path, inputfile, jobs):
+    """
+    Record that the first ``jobs`` rows of an input file are done. The
+    checkpoint file is replaced, so that it is never seen partly written.
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fp:
+        json.dump({'input': inputfile, 'jobs': jobs}, fp)
+        fp.write("\n")
+    os.replace(tmp, path)
@@ -0,0 +1,247 @@
+"""
+Metrics for the configurator.
+
+The configurator records how long each configuration change takes, how long
+each phase lasts from admitting the waiting workers until the last of them
+has finished connecting, how long workers wait to be admitted, and how many
+workers take part in each phase. These are kept as histograms with fixed
+buckets, so that they can be recorded cheaply and exported periodically by a
+:class:`MetricsExporter`, either as JSON lines or as a Prometheus text file
+for the node exporter's textfile collector.
+
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+# bucket upper bounds for durations in seconds, 10 us to about 168 s
+TIME_BUCKETS = tuple(1e-5 * 2 ** i for i in range(25))
+# bucket upper bounds for numbers of workers, 1 to 65536
+COUNT_BUCKETS = tuple(2 ** i for i in range(17))
+
+class Histogram:
+    """
+    Counts observations in buckets with fixed upper bounds, and keeps their
+    sum, minimum and maximum.
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        i = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def merge(self, other):
+        """
+        Add the observations counted by another histogram with the same
+        bounds.
+        """
+        for (i, n) in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or
+                                      other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, q):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in
+        (or the maximum, for the overflow bucket).
+        """
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': [[bound, n] for (bound, n) in
+                        zip(self.bounds + ('+Inf',), self.buckets) if n],
+        }
+
+    def prometheus(self, name, labels=""):
+        """
+        Format the histogram in the Prometheus text exposition format,
+        without the TYPE line.
+        """
+        lines = []
+        cumulative = 0
+        sep = "," if labels else ""
+        for (bound, n) in zip(self.bounds, self.buckets):
+            cumulative += n
+            lines.append('%s_bucket{%s%sle="%g"} %u' %
+                         (name, labels, sep, bound, cumulative))
+        lines.append('%s_bucket{%s%sle="+Inf"} %u' %
+                     (name, labels, sep, self.count))
+        labels = "{" + labels + "}" if labels else ""
+        lines.append('%s_sum%s %r' % (name, labels, float(self.sum)))
+        lines.append('%s_count%s %u' % (name, labels, self.count))
+        return lines
+
+class ConfiguratorMetrics:
+    """
+    Histograms of configurator activity, for both configurations.
+
+     * ``set_seconds``: time taken by config_zero and config_one
+     * ``phase_seconds``: time from admitting the waiting workers to a
+       configuration until the last of them leaves it
+     * ``wait_seconds``: time workers wait in enter_config
+     * ``phase_workers``: number of workers admitted to each phase
+
+    Workers in worker processes record their waits in their own copy, which
+    is added to the spider's with :meth:`merge_waits` when the process
+    finishes, so until then ``wait_seconds`` only covers workers in the
+    spider's own process.
+    """
+    def __init__(self):
+        # held while recording or reading the histograms
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.set_seconds = [Histogram(TIME_BUCKETS), Histogram(TIME_BUCKETS)]
+        self.phase_seconds = [Histogram(TIME_BUCKETS),
+                              Histogram(TIME_BUCKETS)]
+        self.wait_seconds = [Histogram(TIME_BUCKETS), Histogram(TIME_BUCKETS)]
+        self.phase_workers = [Histogram(COUNT_BUCKETS),
+                              Histogram(COUNT_BUCKETS)]
+
+    def merge_waits(self, wait_seconds):
+        """
+        Add the ``wait_seconds`` histograms recorded by another process.
+        """
+        with self.lock:
+            for (mine, theirs) in zip(self.wait_seconds, wait_seconds):
+                mine.merge(theirs)
+
+    def config_changes(self):
+        return self.set_seconds[0].count + self.set_seconds[1].count
+
+    def changes_per_second(self):
+        elapsed = time.monotonic() - self.started
+        return self.config_changes() / elapsed if elapsed > 0 else 0
+
+    def to_dict(self):
+        metrics = {
+            'time': time.time(),
+            'config_changes': self.config_changes(),
+            'config_changes_per_second': self.changes_per_second(),
+        }
+        for name in ('set_seconds', 'phase_seconds', 'wait_seconds',
+                     'phase_workers'):
+            for config in (0, 1):
+                metrics['config%u_%s' % (config, name)] = \
+                        getattr(self, name)[config].to_dict()
+        return metrics
+
+    def prometheus(self):
+        lines = [
+            '# TYPE pathspider_config_changes_total counter',
+            'pathspider_config_changes_total %u' % self.config_changes(),
+            '# TYPE pathspider_config_changes_per_second gauge',
+            'pathspider_config_changes_per_second %r' %
+                    self.changes_per_second(),
+        ]
+        for name in ('set_seconds', 'phase_seconds', 'wait_seconds',
+                     'phase_workers'):
+            metric = 'pathspider_config_' + name
+            lines.append('# TYPE %s histogram' % metric)
+            for config in (0, 1):
+                lines.extend(getattr(self, name)[config].prometheus(
+                        metric, 'config="%u"' % config))
+        return "\n".join(lines) + "\n"
+
+METRICS_JSONL = "jsonl"
+METRICS_PROMETHEUS = "prometheus"
+
+class MetricsExporter:
+    """
+    Thread writing the configurator metrics of a spider to a file every
+    ``interval`` seconds, and once more when stopped.
+
+    In "jsonl" format, a JSON object is appended to the file for each
+    export. In "prometheus" format, the file is replaced with the current
+    metrics in the Prometheus text format each time.
+    """
+    def __init__(self, spider, path, format=METRICS_JSONL, interval=10):
+        if format not in (METRICS_JSONL, METRICS_PROMETHEUS):
+            raise ValueError("unknown metrics format " + repr(format))
+
+        self.spider = spider
+        self.path = path
+        self.format = format
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name="metrics_exporter",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.export()
+        self.export()
+
+    def export(self):
+        metrics = self.spider.config_metrics
+        with metrics.lock:
+            if self.format == METRICS_JSONL:
+                data = json.dumps(metrics.to_dict()) + "\n"
+            else:
+                data = metrics.prometheus()
+
+        try:
+            if self.format == METRICS_JSONL:
+                with open(self.path, "a") as f:
+                    f.write(data)
+            else:
+                # write and rename, so that readers never see a partial file
+                tmp = self.path + ".tmp"
+                with open(tmp, "w") as f:
+                    f.write(data)
+                os.replace(tmp, self.path)
+        except OSError as e:
+            logging.getLogger('pathspider').warning(
+                    "cannot export metrics to %s: %s", self.path, e)
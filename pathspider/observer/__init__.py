@@ -1,11 +1,17 @@
 import collections
 import logging
-import base64
-import heapq
+import json
+import time
 import queue
+import threading
 
 import multiprocessing as mp
 
+from pathspider.observer.record import flow_fields
+from pathspider.observer.record import chain_fields
+from pathspider.observer.record import compact_record_type
+from pathspider.observer.timer import PacketClockTimerQueue
+
 # these three for debugging
 import sys
 import pdb
@@ -13,32 +19,276 @@ import traceback
 
 SHUTDOWN_SENTINEL = None
 
-def _flow4_ids(ip):
+# A completed flow is emitted this many seconds of packet time later
+FLOW_EXPIRY_DELAY = 5
+# Flows which have seen no packets for this many seconds of packet time are
+# completed, checked every IDLE_CHECK_INTERVAL seconds
+FLOW_IDLE_TIMEOUT = 30
+IDLE_CHECK_INTERVAL = 5
+
+# The longest an observer holds a flow after its last packet, in seconds of
+# packet time, before emitting it
+FLOW_MAX_HOLD = FLOW_IDLE_TIMEOUT + IDLE_CHECK_INTERVAL + FLOW_EXPIRY_DELAY
+
+def _flow4_key(ip):
+    """
+    Get a direction-independent flow key for an IPv4 packet.
+
+    The key is the raw bytes of the lower (address, port) endpoint, the
+    higher endpoint and the protocol number, so both directions of a flow
+    share one key.
+
+    :returns: tuple -- The flow key, and True if the packet was sent from
+              the higher endpoint.
+    """
     # FIXME keep map of fragment IDs to keys
     # FIXME link ICMP by looking at payload
-    if ip.proto == 6 or ip.proto == 17 or ip.proto == 132:
+    hdr = ip.data
+    proto = hdr[9:10]
+    if proto == b'\x06' or proto == b'\x11' or proto == b'\x84':
         # key includes ports
-        fid = ip.src_prefix.addr + ip.dst_prefix.addr + ip.data[9:10] + ip.payload[0:4]
-        rid = ip.dst_prefix.addr + ip.src_prefix.addr + ip.data[9:10] + ip.payload[2:4] + ip.payload[0:2]
+        ports = ip.payload[0:4]
+        src = hdr[12:16] + ports[0:2]
+        dst = hdr[16:20] + ports[2:4]
     else:
         # no ports, just 3-tuple
-        fid = ip.src_prefix.addr + ip.dst_prefix.addr + ip.data[9:10]
-        rid = ip.dst_prefix.addr + ip.src_prefix.addr + ip.data[9:10]
-    return (base64.b64encode(fid), base64.b64encode(rid))
+        src = hdr[12:16]
+        dst = hdr[16:20]
 
-def _flow6_ids(ip6):
+    if src <= dst:
+        return (src + dst + proto, False)
+    else:
+        return (dst + src + proto, True)
+
+def _flow6_key(ip6):
+    """
+    Get a direction-independent flow key for an IPv6 packet.
+
+    :see also: :func:`_flow4_key`
+    """
     # FIXME link ICMP by looking at payload
-    if ip6.proto == 6 or ip6.proto == 17 or ip6.proto == 132:
+    hdr = ip6.data
+    proto = ip6.proto
+    if proto == 6 or proto == 17 or proto == 132:
         # key includes ports
-        fid = ip6.src_prefix.addr + ip6.dst_prefix.addr + ip6.data[6:7] + ip6.payload[0:4]
-        rid = ip6.dst_prefix.addr + ip6.src_prefix.addr + ip6.data[6:7] + ip6.payload[2:4] + ip6.payload[0:2]
+        ports = ip6.payload[0:4]
+        src = hdr[8:24] + ports[0:2]
+        dst = hdr[24:40] + ports[2:4]
     else:
         # no ports, just 3-tuple
-        fid = ip6.src_prefix.addr + ip6.dst_prefix.addr + ip6.data[6:7]
-        rid = ip6.dst_prefix.addr + ip6.src_prefix.addr + ip6.data[6:7]
-    return (base64.b64encode(fid), base64.b64encode(rid))
+        src = hdr[8:24]
+        dst = hdr[24:40]
+
+    if src <= dst:
+        return (src + dst + hdr[6:7], False)
+    else:
+        return (dst + src + hdr[6:7], True)
+
+# lengths of the address and port fields at each end of a flow key, by the
+# length of the key
+_KEY_LAYOUTS = {13: (4, 2), 9: (4, 0), 37: (16, 2), 33: (16, 0)}
+
+# multiplier mixing the low bits of a flow key hash into its high bits
+_SHARD_MIX = 0x9e3779b1
+
+def shard_hash(key):
+    """
+    Hash a flow key for partitioning flows between observers: the exclusive
+    or of the 32-bit words of both addresses and of both ports, multiplied
+    by :data:`_SHARD_MIX` modulo 2^32 and shifted right 16 bits. This is the
+    hash computed by the filter from :func:`shard_filter`, in the 32-bit
+    arithmetic of BPF. Keys of any other length hash to 0.
+    """
+    layout = _KEY_LAYOUTS.get(len(key))
+    if layout is None:
+        return 0
+    (alen, plen) = layout
+    h = 0
+    for end in (0, alen + plen):
+        for i in range(end, end + alen, 4):
+            h ^= int.from_bytes(key[i:i+4], 'big')
+        if plen:
+            h ^= int.from_bytes(key[end+alen:end+alen+plen], 'big')
+    return ((h * _SHARD_MIX) & 0xffffffff) >> 16
+
+def shard_filter(shard, shard_count):
+    """
+    Make a BPF filter expression passing only the packets of flows whose
+    :func:`shard_hash` falls in one partition.
+
+    Both the addresses and the ports are combined with exclusive or, so both
+    directions of a flow pass the same filter. The ports of IPv6 packets are
+    read straight after the fixed header, so IPv6 packets with extension
+    headers, like IPv4 fragments after the first, are partitioned on their
+    addresses alone. The same clauses are repeated for packets with a VLAN
+    tag.
+    """
+    addrs4 = "ip[12:4] ^ ip[16:4]"
+    addrs6 = " ^ ".join("ip6[%u:4]" % i for i in range(8, 40, 4))
+
+    def match(words):
+        return "((((%s) * 0x%x) >> 16) %% %u) = %u" % (
+                words, _SHARD_MIX, shard_count, shard)
+
+    clauses = []
+    for proto in ("tcp", "udp", "sctp"):
+        # libpcap only reads tcp[] and the like from first fragments
+        ports = "%s ^ %s[0:2] ^ %s[2:2]" % (addrs4, proto, proto)
+        clauses.append("(ip and %s and %s)" % (proto, match(ports)))
+    clauses.append("(ip and ((ip[6:2] & 0x1fff) != 0 or "
+                   "not (tcp or udp or sctp)) and %s)" % match(addrs4))
+
+    # libpcap's tcp[] and the like only read IPv4 packets
+    for number in (6, 17, 132):
+        ports = "%s ^ ip6[40:2] ^ ip6[42:2]" % addrs6
+        clauses.append("(ip6 and ip6[6] = %u and %s)" % (number,
+                                                         match(ports)))
+    clauses.append("(ip6 and ip6[6] != 6 and ip6[6] != 17 and "
+                   "ip6[6] != 132 and %s)" % match(addrs6))
+
+    # the vlan keyword moves the offsets of everything after it
+    expr = " or ".join(clauses)
+    return "(%s) or (vlan and (%s))" % (expr, expr)
+
+# chains of an Observer, in the order they are reported by profile()
+CHAINS = ('new_flow', 'ip4', 'ip6', 'tcp', 'udp', 'l4')
+
+def _profiled_chain(chain, chain_stats, fn_stats, short_circuit=True):
+    """
+    Wrap a chain of functions in a single function which runs them with the
+    same semantics as the Observer (see :func:`compose_chain`), accumulating
+    call counts and time spent for the chain as a whole and for each
+    function.
+    """
+    perf_counter = time.perf_counter
+    fns = list(zip(chain, fn_stats))
+
+    def run_chain(rec, hdr, **kwargs):
+        chain_start = perf_counter()
+        keep = True
+        for (fn, stats) in fns:
+            start = perf_counter()
+            if not fn(rec, hdr, **kwargs):
+                keep = False
+            stats[0] += 1
+            stats[1] += perf_counter() - start
+            if short_circuit and not keep:
+                break
+        chain_stats[0] += 1
+        chain_stats[1] += perf_counter() - chain_start
+        return keep
+
+    return run_chain
+
+def compose_chain(chain, short_circuit=True):
+    """
+    Compose a chain of packet functions into a single function taking
+    ``(rec, hdr, rev)`` and returning False if the flow is complete.
+
+    With ``short_circuit``, the functions after the first one to return
+    False are not called. Otherwise every function is called, and the flow
+    is complete if any of them returned False.
+
+    :returns: The composed function, or None for an empty chain.
+    """
+    fns = tuple(chain)
+
+    if len(fns) == 0:
+        return None
+    elif len(fns) == 1:
+        (f0,) = fns
+        def run_chain(rec, hdr, rev):
+            return bool(f0(rec, hdr, rev=rev))
+    elif len(fns) == 2 and short_circuit:
+        (f0, f1) = fns
+        def run_chain(rec, hdr, rev):
+            return bool(f0(rec, hdr, rev=rev) and f1(rec, hdr, rev=rev))
+    elif len(fns) == 2:
+        (f0, f1) = fns
+        def run_chain(rec, hdr, rev):
+            k0 = f0(rec, hdr, rev=rev)
+            k1 = f1(rec, hdr, rev=rev)
+            return bool(k0 and k1)
+    elif short_circuit:
+        def run_chain(rec, hdr, rev):
+            for fn in fns:
+                if not fn(rec, hdr, rev=rev):
+                    return False
+            return True
+    else:
+        def run_chain(rec, hdr, rev):
+            keep = True
+            for fn in fns:
+                if not fn(rec, hdr, rev=rev):
+                    keep = False
+            return keep
 
-PacketClockTimer = collections.namedtuple("PacketClockTimer", ("time", "fn"))
+    return run_chain
+
+def compile_dispatch(ip4_chain=(), ip6_chain=(), tcp_chain=(),
+                     udp_chain=(), l4_chain=(), short_circuit=True):
+    """
+    Compile the packet chains of an Observer into a single function which
+    runs the right chains for a packet, taking ``(rec, pkt, ip, ip6, rev)``
+    where ``ip`` and ``ip6`` are the packet's network layer headers, already
+    fetched by the caller. Each transport layer header is fetched from the
+    packet at most once.
+
+    With ``short_circuit`` (the default), once any function returns False
+    no further functions are called for the packet, in this chain or in the
+    transport layer chain. Otherwise every function in the chains for the
+    packet is called.
+
+    :returns: function -- Returns False if the flow is complete.
+    """
+    run_ip4 = compose_chain(ip4_chain, short_circuit)
+    run_ip6 = compose_chain(ip6_chain, short_circuit)
+    run_tcp = compose_chain(tcp_chain, short_circuit)
+    run_udp = compose_chain(udp_chain, short_circuit)
+    run_l4 = compose_chain(l4_chain, short_circuit)
+
+    def dispatch(rec, pkt, ip, ip6, rev):
+        # run IP header chains
+        keep = True
+        if ip:
+            if run_ip4 is not None:
+                keep = run_ip4(rec, ip, rev)
+        elif ip6:
+            if run_ip6 is not None:
+                keep = run_ip6(rec, ip6, rev)
+
+        if short_circuit and not keep:
+            return False
+
+        # run transport header chains
+        tcp = pkt.tcp
+        if tcp:
+            if run_tcp is not None:
+                return run_tcp(rec, tcp, rev) and keep
+        else:
+            udp = pkt.udp
+            if udp:
+                if run_udp is not None:
+                    return run_udp(rec, udp, rev) and keep
+            elif run_l4 is not None:
+                return run_l4(rec, pkt, rev) and keep
+
+        return keep
+
+    return dispatch
+
+class _FlowEntry:
+    """
+    Flow table entry: the flow record, the direction of the first packet
+    of the flow relative to the flow key, and whether the flow has been
+    completed and is waiting to be emitted.
+    """
+    __slots__ = ('rec', 'swapped', 'expiring')
+
+    def __init__(self, rec, swapped):
+        self.rec = rec
+        self.swapped = swapped
+        self.expiring = False
 
 class Observer:
     """
@@ -54,7 +304,9 @@ class Observer:
                  ip6_chain=[],
                  tcp_chain=[],
                  udp_chain=[],
-                 l4_chain=[]):
+                 l4_chain=[],
+                 compact_records=False,
+                 short_circuit=True):
         """
         Create an Observer.
 
@@ -70,6 +322,15 @@ class Observer:
         :type udp_chain: array(function)
         :param l4_chain: Array of functions to pass other layer 4 headers to.
         :type l4_chain: array(function)
+        :param compact_records: Store flow records in a class with a slot
+                                for each field declared by the chain
+                                functions instead of in a dict; see
+                                :meth:`use_compact_records`.
+        :type compact_records: bool
+        :param short_circuit: Stop calling functions for a packet as soon as
+                              one returns False. If False, every function
+                              in the chains for a packet is called.
+        :type short_circuit: bool
         :see also: :ref:`Observer Documentation <observer>`
         """
 
@@ -81,6 +342,7 @@ class Observer:
         self._irq_fired = False
 
         # Libtrace initialization
+        self._lturi = lturi
         self._trace = libtrace.trace(lturi)
         self._trace.start()
         self._pkt = libtrace.packet()
@@ -92,25 +354,193 @@ class Observer:
         self._tcp_chain = tcp_chain
         self._udp_chain = udp_chain
         self._l4_chain = l4_chain
+        self._short_circuit = short_circuit
+        self._compile()
+
+        # Flow record type; see use_compact_records()
+        self._record_type = dict
+        if compact_records:
+            self.use_compact_records()
 
         # Packet timer and timer queue
         self._pt = 0                   # current packet timer
-        self._tq = []                  # packet timer queue (heap)
+        self._tq = PacketClockTimerQueue() # packet timer queue
+        self._next_idle_check = 0      # packet time to look for idle flows
 
-        # Flow tables
-        self._active = {}
-        self._expiring = {}
-        self._ignored = set()
+        # Flow table: maps flow keys to a _FlowEntry for active and
+        # expiring flows, or to None for flows we are ignoring
+        self._flows = {}
 
         # Emitter queue
         self._emitted = collections.deque()
 
+        # Flow partition handled by this observer, and whether packets of
+        # other partitions reach it; see set_shard()
+        self._shard = 0
+        self._shard_count = 1
+        self._shard_check = False
+
+        # Chain profiling; see enable_profiling()
+        self._profile = None
+
         # Statistics
         self._ct_pkt = 0
         self._ct_nonip = 0
         self._ct_shortkey = 0
         self._ct_ignored = 0
+        self._ct_othershard = 0
         self._ct_flow = 0
+        self._ct_enqueued = 0
+        self._ct_batches = 0
+
+    def set_shard(self, shard, shard_count):
+        """
+        Only track flows in one partition of the flow space, so that several
+        observers reading the same packet source can share the work.
+
+        Flows are partitioned on :func:`shard_hash` of the
+        direction-independent flow key, so both directions of a flow are
+        handled by the same observer. The packet source is reopened with a
+        BPF filter from :func:`shard_filter`, so that on a live interface the
+        kernel only passes the observer the packets of its own partition. If
+        python-libtrace or the packet source cannot filter, the observer
+        reads every packet and drops those of other partitions itself.
+
+        :param shard: The partition handled by this observer, from 0.
+        :type shard: int
+        :param shard_count: The total number of partitions.
+        :type shard_count: int
+        """
+        self._shard = shard
+        self._shard_count = shard_count
+        self._shard_check = (shard_count > 1 and not
+                             self._filter_trace(shard_filter(shard,
+                                                             shard_count)))
+
+    def _filter_trace(self, expr):
+        """
+        Replace the trace with one of the same packet source, passing only
+        the packets matching a BPF filter expression.
+
+        :returns: bool -- False if the filter could not be set, in which
+                  case the trace is left as it was.
+        """
+        logger = logging.getLogger("observer")
+
+        import plt as libtrace
+        trace = None
+        try:
+            trace = libtrace.trace(self._lturi)
+            trace.conf_filter(libtrace.filter(expr))
+            trace.start()
+        except Exception as e:
+            logger.warning("cannot filter %s, reading every packet: %s",
+                           self._lturi, e)
+            if trace is not None:
+                trace.close()
+            return False
+
+        # stop capturing every packet for the old trace
+        self._trace.close()
+        self._trace = trace
+        return True
+
+    def use_compact_records(self):
+        """
+        Store flow records in a class with a slot for each field declared by
+        the chain functions instead of in a dict, using less memory per flow
+        at the cost of slower field access. Must be called before
+        :meth:`enable_profiling`.
+
+        :see also: :mod:`pathspider.observer.record`
+        """
+        self._record_type = compact_record_type(chain_fields(
+                self._new_flow_chain, self._ip4_chain, self._ip6_chain,
+                self._tcp_chain, self._udp_chain, self._l4_chain))
+
+    def set_port_range(self, low, high, bypass=None):
+        """
+        Only track flows with a port from ``low`` up to but not including
+        ``high`` at either end, such as the source ports the spider's
+        workers bind to.
+
+        The ports are checked before the rest of the new flow chain is run,
+        and flows outside the range are ignored, so each later packet of
+        them only costs a lookup in the flow table. While ``bypass``, a
+        shared :func:`multiprocessing.RawValue`, is nonzero, new flows are
+        tracked whatever their ports. Must be called once, before
+        :meth:`enable_profiling`.
+        """
+        self._new_flow_chain = ([port_range_filter(low, high, bypass)] +
+                                list(self._new_flow_chain))
+
+    def enable_profiling(self):
+        """
+        Count calls and time spent in each chain, and in each function in
+        each chain. The results are available from :meth:`profile` and are
+        logged when the observer shuts down.
+
+        Each chain is replaced with a wrapper which times it, so there is
+        no cost when profiling is not enabled. Must be called before the
+        observer starts processing packets.
+        """
+        if self._profile is not None:
+            return
+
+        self._profile = []
+        for chain in CHAINS:
+            attr = "_" + chain + "_chain"
+            fns = getattr(self, attr)
+            chain_stats = [0, 0.0]
+            fn_stats = [[0, 0.0] for fn in fns]
+            self._profile.append((chain, fns, chain_stats, fn_stats))
+            if fns:
+                setattr(self, attr,
+                        [_profiled_chain(fns, chain_stats, fn_stats,
+                                         self._short_circuit)])
+        self._compile()
+
+    def profile(self):
+        """
+        Get the chain profile collected since :meth:`enable_profiling` was
+        called.
+
+        :returns: list -- A dict for each chain, with the chain name, the
+                  number of calls and total nanoseconds spent in the chain,
+                  and a list of dicts with the same for each function; or
+                  None if profiling is not enabled.
+        """
+        if self._profile is None:
+            return None
+
+        return [{'chain': chain,
+                 'calls': chain_stats[0],
+                 'ns': int(chain_stats[1] * 1e9),
+                 'functions': [{'function': fn.__name__,
+                                'calls': stats[0],
+                                'ns': int(stats[1] * 1e9)}
+                               for (fn, stats) in zip(fns, fn_stats)]}
+                for (chain, fns, chain_stats, fn_stats) in self._profile]
+
+    def _log_profile(self, logger, prefix):
+        for chain in self.profile():
+            if not chain['calls']:
+                continue
+            logger.info(prefix+"%s chain: %u calls, %.0f ns/call (%s)" % (
+                chain['chain'], chain['calls'],
+                chain['ns'] / chain['calls'],
+                ", ".join("%s %.0f ns" % (fn['function'],
+                                          fn['ns'] / fn['calls'])
+                          for fn in chain['functions'] if fn['calls'])))
+        logger.info(prefix+"chain profile: " + json.dumps(self.profile()))
+
+    def _compile(self):
+        """
+        Compile the packet chains into the per-packet dispatch function.
+        """
+        self._dispatch = compile_dispatch(self._ip4_chain, self._ip6_chain,
+                                          self._tcp_chain, self._udp_chain,
+                                          self._l4_chain, self._short_circuit)
 
     def _interrupted(self):
         try:
@@ -135,10 +565,13 @@ class Observer:
         self._ct_pkt += 1
 
         # advance the packet clock
-        self._tick(self._pkt.seconds)
+        pkt = self._pkt
+        self._tick(pkt.seconds)
 
         # get a flow ID and associated flow record for the packet
-        (fid, rec, rev) = self._get_flow()
+        ip = pkt.ip
+        ip6 = None if ip else pkt.ip6
+        (fid, rec, rev) = self._get_flow(ip, ip6)
 
         # don't dispatch if we don't have a record
         # (this happens for non-IP packets and flows
@@ -146,26 +579,8 @@ class Observer:
         if not rec:
             return True
 
-        keep_flow = True
-
-        # run IP header chains
-        if self._pkt.ip:
-            for fn in self._ip4_chain:
-                keep_flow = keep_flow and fn(rec, self._pkt.ip, rev=rev)
-        elif self._pkt.ip6:
-            for fn in self._ip6_chain:
-                keep_flow = keep_flow and fn(rec, self._pkt.ip6, rev=rev)
-
-        # run transport header chains
-        if self._pkt.tcp:
-            for fn in self._tcp_chain:
-                keep_flow = keep_flow and fn(rec, self._pkt.tcp, rev=rev)
-        elif self._pkt.udp:
-            for fn in self._udp_chain:
-                keep_flow = keep_flow and fn(rec, self._pkt.udp, rev=rev)
-        else:
-            for fn in self._l4_chain:
-                keep_flow = keep_flow and fn(rec, self._pkt, rev=rev)
+        # run the compiled header chains
+        keep_flow = self._dispatch(rec, pkt, ip, ip6, rev)
 
         # complete the flow if any chain function asked us to
         if not keep_flow:
@@ -176,23 +591,21 @@ class Observer:
 
     def _set_timer(self, delay, fid):
         # add to queue
-        heapq.heappush(self._tq, PacketClockTimer(self._pt + delay,
-                       self._finish_expiry_tfn(fid)))
+        self._tq.schedule(self._pt + delay, self._finish_expiry_tfn(fid))
 
-    def _get_flow(self):
+    def _get_flow(self, ip, ip6):
         """
-        Get a flow record for the given packet.
-        Create a new basic flow record
+        Get a flow record for the given packet, given its IPv4 or IPv6
+        header. Create a new basic flow record
         """
         logger = logging.getLogger("observer")
-        # get possible a flow IDs for the packet
+        # get the flow key for the packet
         try:
-            if self._pkt.ip:
-                (ffid, rfid) = _flow4_ids(self._pkt.ip)
-                ip = self._pkt.ip
-            elif self._pkt.ip6:
-                (ffid, rfid) = _flow6_ids(self._pkt.ip6)
-                ip = self._pkt.ip6
+            if ip:
+                (key, swapped) = _flow4_key(ip)
+            elif ip6:
+                (key, swapped) = _flow6_key(ip6)
+                ip = ip6
             else:
                 # we don't care about non-IP packets
                 self._ct_nonip += 1
@@ -201,63 +614,59 @@ class Observer:
             self._ct_shortkey += 1
             return (None, None, False)
 
-        # now look for forward and reverse in ignored, active,
-        # and expiring tables.
-        if ffid in self._ignored:
+        # leave flows in other partitions to their own observers
+        if self._shard_check and \
+                shard_hash(key) % self._shard_count != self._shard:
+            self._ct_othershard += 1
             return (None, None, False)
-        elif rfid in self._ignored:
+
+        # one lookup finds ignored, active and expiring flows
+        # in either direction
+        entry = self._flows.get(key, False)
+        if entry is None:
             return (None, None, False)
-        elif ffid in self._active:
-            (fid, rec) = (ffid, self._active[ffid])
-            #logger.debug("found forward flow for "+str(ffid))
-        elif ffid in self._expiring:
-            (fid, rec) = (ffid, self._expiring[ffid])
-            #logger.debug("found expiring forward flow for "+str(ffid))
-        elif rfid in self._active:
-            (fid, rec) = (rfid, self._active[rfid])
-            #logger.debug("found reverse flow for "+str(rfid))
-        elif rfid in self._expiring:
-            (fid, rec) =  (rfid, self._expiring[rfid])
-            #logger.debug("found expiring reverse flow for "+str(rfid))
-        else:
+        elif entry is False:
             # nowhere to be found. new flow.
-            rec = {'first': ip.seconds}
+            rec = self._record_type()
+            rec['first'] = ip.seconds
             for fn in self._new_flow_chain:
                 if not fn(rec, ip):
-                    #logger.debug("ignoring "+str(ffid))
-                    self._ignored.add(ffid)
+                    #logger.debug("ignoring "+str(key))
+                    self._flows[key] = None
                     self._ct_ignored += 1
                     return (None, None, False)
 
             # wasn't vetoed. add to active table.
-            fid = ffid
-            self._active[ffid] = rec
-            #logger.debug("new flow for "+str(ffid))
+            entry = _FlowEntry(rec, swapped)
+            self._flows[key] = entry
+            #logger.debug("new flow for "+str(key))
             self._ct_flow += 1
-
+        else:
+            rec = entry.rec
 
         # update time and return record
         rec['last'] = ip.seconds
-        return (fid, rec, bool(fid == rfid))
+        return (key, rec, swapped != entry.swapped)
 
-    def _flow_complete(self, fid, delay=5):
+    def _flow_complete(self, fid, delay=FLOW_EXPIRY_DELAY):
         """
         Mark a given flow ID as complete
         """
         logger = logging.getLogger("observer")
         # move flow to expiring table
         # logging.debug("Moving flow " + str(fid) + " to expiring queue")
-        try:
-            self._expiring[fid] = self._active[fid]
-        except KeyError:
+        entry = self._flows.get(fid)
+        if entry is None or entry.expiring:
             #logger.debug("Tried to expire an already expired flow")
-            pass
-        else:
-            del self._active[fid]
-            # set up a timer to fire to emit the flow after timeout
-            self._set_timer(delay, fid)
+            return
+
+        entry.expiring = True
+        # set up a timer to fire to emit the flow after timeout
+        self._set_timer(delay, fid)
 
     def _emit_flow(self, rec):
+        if self._record_type is not dict:
+            rec = rec.to_dict()
         self._emitted.append(rec)
 
     def _next_flow(self):
@@ -272,66 +681,185 @@ class Observer:
         self._pt = pt
 
         # fire all timers whose time has come
-        while len(self._tq) > 0 and pt > min(self._tq, key=lambda x: x.time).time:
+        for fn in self._tq.expired(pt):
             try:
-                heapq.heappop(self._tq).fn()
+                fn()
             except:
                 type, value, tb = sys.exc_info()
                 traceback.print_exc()
                 pdb.post_mortem(tb)
 
+        # complete flows which have gone idle, so that they are not held
+        # until the observer shuts down
+        if pt >= self._next_idle_check:
+            self._next_idle_check = pt + IDLE_CHECK_INTERVAL
+            self.purge_idle()
+
     def _finish_expiry_tfn(self, fid):
         """
         On expiry timer, emit the flow
         and delete it from the expiring queue
         """
         def tfn():
-            if fid in self._expiring:
-                self._emit_flow(self._expiring[fid])
-                del self._expiring[fid]
+            entry = self._flows.get(fid)
+            if entry is not None and entry.expiring:
+                self._emit_flow(entry.rec)
+                del self._flows[fid]
         return tfn
 
-    def purge_idle(self, timeout=30):
-        # TODO test this, it's probably pretty slow.
-        for fid in self._active:
-            if self._pt - self._active['fid']['last'] > timeout:
+    def purge_idle(self, timeout=FLOW_IDLE_TIMEOUT):
+        """
+        Complete flows which have seen no packets for ``timeout`` seconds of
+        packet time, such as timed out connections and flows which never saw
+        a FIN or RST. This is called from the packet clock every
+        :data:`IDLE_CHECK_INTERVAL` seconds, and looks at every active flow.
+        """
+        for (fid, entry) in list(self._flows.items()):
+            if (entry is not None and not entry.expiring and
+                    self._pt - entry.rec['last'] > timeout):
                 self._flow_complete(fid)
 
     def flush(self):
-        for fid in self._expiring:
-            self._emit_flow(self._expiring[fid])
-        self._expiring.clear()
+        for entry in self._flows.values():
+            if entry is not None:
+                self._emit_flow(entry.rec)
+        self._flows.clear()
 
-        for fid in self._active:
-            self._emit_flow(self._active[fid])
-        self._active.clear()
+        # nothing left for pending expiry timers to do
+        self._tq.clear()
 
-        self._ignored.clear()
+    def _put_flows(self, flowqueue, flows, batch_size):
+        """
+        Put emitted flows on the flow queue, one at a time if batch_size is
+        1, otherwise as lists of at most batch_size flows.
+        """
+        if batch_size <= 1:
+            for f in flows:
+                flowqueue.put(f)
+            self._ct_batches += len(flows)
+        else:
+            for i in range(0, len(flows), batch_size):
+                flowqueue.put(flows[i:i+batch_size])
+                self._ct_batches += 1
+        self._ct_enqueued += len(flows)
+
+    def _enqueue_flows(self, flowqueue, batch_size, batch_delay):
+        """
+        Process packets until the packet source is exhausted or we are
+        interrupted, putting emitted flows on the flow queue.
 
-    def run_flow_enqueuer(self, flowqueue, irqueue=None):
+        With a batch_size above 1, emitted flows are passed to a flusher
+        thread (see :meth:`_flush_batches`), so that a batch is put on the
+        flow queue once its oldest flow has waited batch_delay seconds even
+        if no more packets arrive.
+        """
+        if batch_size <= 1:
+            while self._next_packet():
+                if self._emitted:
+                    self._put_flows(flowqueue, list(self._emitted), 1)
+                    self._emitted.clear()
+            return
+
+        pending = queue.Queue()
+        flusher = threading.Thread(target=self._flush_batches,
+                                   args=(flowqueue, pending,
+                                         batch_size, batch_delay),
+                                   name="flow_flusher",
+                                   daemon=True)
+        flusher.start()
+
+        try:
+            while self._next_packet():
+                if self._emitted:
+                    pending.put(list(self._emitted))
+                    self._emitted.clear()
+        finally:
+            pending.put(SHUTDOWN_SENTINEL)
+            flusher.join()
+
+    def _flush_batches(self, flowqueue, pending, batch_size, batch_delay):
+        """
+        Collect lists of emitted flows from the pending queue into batches,
+        putting a batch on the flow queue when batch_size flows are waiting
+        or the oldest has waited batch_delay seconds, and the rest when the
+        shutdown sentinel arrives.
+        """
+        batch = []
+        deadline = None
+
+        while True:
+            if batch:
+                timeout = max(deadline - time.monotonic(), 0)
+            else:
+                timeout = None
+
+            try:
+                flows = pending.get(timeout=timeout)
+            except queue.Empty:
+                flows = []
+
+            if flows is SHUTDOWN_SENTINEL:
+                if batch:
+                    self._put_flows(flowqueue, batch, batch_size)
+                return
+
+            if flows and not batch:
+                deadline = time.monotonic() + batch_delay
+            batch.extend(flows)
+
+            if batch and (len(batch) >= batch_size or
+                          time.monotonic() >= deadline):
+                self._put_flows(flowqueue, batch, batch_size)
+                batch = []
+
+    def run_flow_enqueuer(self, flowqueue, irqueue=None,
+                          batch_size=1, batch_delay=0.1):
+        """
+        Run the observer, putting completed flows on a flow queue.
+
+        :param flowqueue: The queue to put flows on.
+        :type flowqueue: multiprocessing.Queue
+        :param irqueue: A queue which will receive a value when the observer
+                        should stop.
+        :type irqueue: multiprocessing.Queue
+        :param batch_size: Put flows on the queue in lists of up to this many
+                           flows instead of one at a time.
+        :type batch_size: int
+        :param batch_delay: Maximum time in seconds a flow is held back
+                            waiting for a batch to fill.
+        :type batch_delay: float
+        """
         if irqueue:
             self._irq = irqueue
             self._irq_fired = None
 
         # Run main loop until last packet seen
-        # then flush active flows and run again
-        for i in range(2):
-            while True:
-                f = self._next_flow()
-                if f:
-                    flowqueue.put(f)
-                else:
-                    self.flush()
-                    break
+        # then flush active flows
+        start = time.monotonic()
+        self._enqueue_flows(flowqueue, batch_size, batch_delay)
+        self.flush()
+        self._put_flows(flowqueue, list(self._emitted), batch_size)
+        self._emitted.clear()
+        elapsed = time.monotonic() - start
 
         # log observer info on shutdown
-        logging.getLogger("observer").info(
-                ("processed %u packets "+
-                "(%u dropped, %u short, %u non-ip) "+
+        logger = logging.getLogger("observer")
+        if self._shard_count > 1:
+            shard = "shard %u/%u " % (self._shard, self._shard_count)
+        else:
+            shard = ""
+        logger.info(
+                (shard+"processed %u packets "+
+                "(%u dropped, %u short, %u non-ip, %u other shards) "+
                 "into %u flows (%u ignored)") % ( 
                     self._ct_pkt, self._trace.pkt_drops(),
-                    self._ct_shortkey, self._ct_nonip,
+                    self._ct_shortkey, self._ct_nonip, self._ct_othershard,
                     self._ct_flow, self._ct_ignored))
+        logger.info(shard+"enqueued %u flows in %u puts (%.1f flows/s)" % (
+                    self._ct_enqueued, self._ct_batches,
+                    self._ct_enqueued / elapsed if elapsed > 0 else 0))
+        if self._profile is not None:
+            self._log_profile(logger, shard)
 
         flowqueue.put(SHUTDOWN_SENTINEL)
 
@@ -343,6 +871,23 @@ def extract_ports(ip):
     else:
         return (None, None)
 
+def port_range_filter(low, high, bypass=None):
+    """
+    Make a new flow function ignoring flows without a port from ``low`` up
+    to but not including ``high`` at either end, unless ``bypass`` is given
+    and has a nonzero value.
+    """
+    def in_port_range(rec, ip):
+        if bypass is not None and bypass.value:
+            return True
+        (sp, dp) = extract_ports(ip)
+        return ((sp is not None and low <= sp < high) or
+                (dp is not None and low <= dp < high))
+
+    return in_port_range
+
+@flow_fields('sip', 'dip', 'proto', 'sp', 'dp',
+             'pkt_fwd', 'pkt_rev', 'oct_fwd', 'oct_rev')
 def basic_flow(rec, ip):
     """
     New flow function that sets up basic flow information
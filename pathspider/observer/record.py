@@ -0,0 +1,80 @@
+"""
+Compact flow records for the Observer.
+
+By default the Observer keeps each flow record as a :class:`dict`. For large
+numbers of concurrent flows, the Observer can instead use a record class
+with ``__slots__``, which stores each field in a fixed slot rather than a
+hash table. The fields of the class are declared by the chain functions with
+the :func:`flow_fields` decorator, and records are converted back to dicts
+when the flow is emitted, so the merger and plugins see no difference.
+
+Chain functions continue to use ``rec['field']``; item access on a compact
+record is mapped directly onto attribute access. Reading a field which has
+not been set, or setting a field which has not been declared, raises
+:class:`AttributeError`.
+
+"""
+
+# fields set by the Observer itself on every flow record
+OBSERVER_FIELDS = ('first', 'last')
+
+def flow_fields(*fields):
+    """
+    Decorator declaring the flow record fields a chain function sets.
+
+    Only fields which a function creates need to be declared; fields which
+    are updated by a function but created elsewhere (e.g. counters set up by
+    a new flow function) only need to be declared once.
+    """
+    def decorate(fn):
+        fn.flow_fields = fields
+        return fn
+    return decorate
+
+def chain_fields(*chains):
+    """
+    Collect the fields declared by the functions in the given chains, in the
+    order in which they are first declared.
+    """
+    fields = list(OBSERVER_FIELDS)
+    for chain in chains:
+        for fn in chain:
+            for field in getattr(fn, 'flow_fields', ()):
+                if field not in fields:
+                    fields.append(field)
+    return tuple(fields)
+
+class CompactFlowRecord:
+    """
+    Base class for compact flow records. Use :func:`compact_record_type` to
+    create a record class for a particular set of fields.
+    """
+    __slots__ = ()
+
+    # dict-style access to the slots, without a Python-level call
+    __getitem__ = object.__getattribute__
+    __setitem__ = object.__setattr__
+
+    def __contains__(self, field):
+        return hasattr(self, field)
+
+    def to_dict(self):
+        """
+        Convert the record to a dict containing the fields which have been
+        set.
+        """
+        rec = {}
+        for field in self.__slots__:
+            try:
+                rec[field] = getattr(self, field)
+            except AttributeError:
+                pass
+        return rec
+
+def compact_record_type(fields):
+    """
+    Create a compact flow record class with a slot for each of the given
+    fields.
+    """
+    return type('FlowRecord', (CompactFlowRecord,),
+                {'__slots__': tuple(fields)})
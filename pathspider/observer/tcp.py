@@ -1,4 +1,7 @@
+from pathspider.observer.record import flow_fields
 
+
+@flow_fields('fwd_fin', 'fwd_rst', 'rev_fin', 'rev_rst')
 def tcp_setup(rec, ip):
     rec['fwd_fin'] = False
     rec['fwd_rst'] = False
@@ -0,0 +1,84 @@
+"""
+Packet clock timer queue for the Observer.
+
+Timers are kept in a binary heap ordered by expiry time (in packet clock
+seconds), with a sequence number to break ties in insertion order. Firing
+only ever looks at the head of the heap, so advancing the clock costs
+O(1) when no timer is due and O(log n) per timer fired.
+
+Timers can be cancelled; cancelled timers are left in the heap and
+discarded lazily when they reach the head.
+
+"""
+
+import heapq
+import itertools
+
+# indices into a timer entry
+_TIME = 0
+_SEQ = 1
+_FN = 2
+
+class PacketClockTimerQueue:
+    """
+    A heap of timers keyed on packet clock time.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._live = 0
+
+    def __len__(self):
+        return self._live
+
+    def schedule(self, time, fn):
+        """
+        Schedule ``fn`` to be called once the packet clock passes ``time``.
+
+        :returns: A timer handle which can be passed to :meth:`cancel`.
+        """
+        timer = [time, next(self._seq), fn]
+        heapq.heappush(self._heap, timer)
+        self._live += 1
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancel a pending timer. Cancelling a timer that has already fired
+        or been cancelled has no effect.
+        """
+        if timer[_FN] is not None:
+            timer[_FN] = None
+            self._live -= 1
+
+    def next_time(self):
+        """
+        :returns: The expiry time of the next pending timer, or None if no
+                  timers are pending.
+        """
+        heap = self._heap
+        while heap and heap[0][_FN] is None:
+            heapq.heappop(heap)
+        return heap[0][_TIME] if heap else None
+
+    def expired(self, now):
+        """
+        Remove and yield the functions of all timers whose time is
+        before ``now``, in expiry order.
+        """
+        heap = self._heap
+        while heap and now > heap[0][_TIME]:
+            fn = heapq.heappop(heap)[_FN]
+            if fn is not None:
+                self._live -= 1
+                yield fn
+
+    def clear(self):
+        """
+        Cancel all pending timers.
+        """
+        for timer in self._heap:
+            timer[_FN] = None
+        self._heap.clear()
+        self._live = 0
@@ -9,10 +9,12 @@ import collections
 
 from pathspider.base import Spider
 from pathspider.base import NO_FLOW
+from pathspider.base import sock_connect
 
 from pathspider.observer import Observer
 from pathspider.observer import basic_flow
 from pathspider.observer import basic_count
+from pathspider.observer import flow_fields
 
 from pathspider.observer.tcp import tcp_setup
 from pathspider.observer.tcp import tcp_complete
@@ -26,8 +28,27 @@ CONN_OK = 0
 CONN_FAILED = 1
 CONN_TIMEOUT = 2
 
+# traffic class for DSCP class EF (46)
+TOS_EF = 46 << 2
+
+# only connections to this port are marked, in either mode
+MARKED_PORT = 80
+
+# iptables-restore input for each configuration. Declaring the chain
+# empties it, so the rules are replaced in one step.
+MANGLE_CHAIN = "PATHSPIDER"
+RULES_ZERO = (b"*mangle\n"
+              b":PATHSPIDER - [0:0]\n"
+              b"COMMIT\n")
+RULES_ONE = (b"*mangle\n"
+             b":PATHSPIDER - [0:0]\n"
+             b"-A PATHSPIDER -p tcp -m tcp --dport %d "
+             b"-j DSCP --set-dscp-class ef\n" % MARKED_PORT +
+             b"COMMIT\n")
+
 ## Chain functions
 
+@flow_fields('fwd_dscp', 'rev_dscp')
 def dscp_setup(rec, ip):
     rec['fwd_dscp'] = None
     rec['rev_dscp'] = None
@@ -50,20 +71,71 @@ def dscp_extract(rec, ip, rev):
 
 class DSCPSpider(Spider):
 
+    per_socket_config = True
+    binds_source_ports = True
+
     def __init__(self, worker_count, libtrace_uri):
         super().__init__(worker_count=worker_count,
                          libtrace_uri=libtrace_uri)
         self.dscp = None # set by configurator
         self.conn_timeout = 10
 
+        # (iptables, iptables-restore) commands for each address family
+        self.iptables_commands = [('iptables', 'iptables-restore'),
+                                  ('ip6tables', 'ip6tables-restore')]
+        self.chain_ready = False
+
+    def _setup_chain(self):
+        """
+        Creates the PATHSPIDER chain in the mangle table, if it does not
+        exist, and jumps to it from OUTPUT. This is done once, so that
+        configuration changes only need to replace the rules in the chain.
+        """
+
+        for (iptables, iptables_restore) in self.iptables_commands:
+            subprocess.run([iptables_restore, '--noflush'],
+                           input=RULES_ZERO, check=True)
+            if subprocess.call([iptables, '-t', 'mangle', '-C', 'OUTPUT',
+                                '-j', MANGLE_CHAIN],
+                               stderr=subprocess.DEVNULL) != 0:
+                subprocess.check_call([iptables, '-t', 'mangle', '-A',
+                                       'OUTPUT', '-j', MANGLE_CHAIN])
+        self.chain_ready = True
+
+    def _remove_chain(self):
+        """
+        Removes the jump from OUTPUT to the PATHSPIDER chain, and the chain.
+        """
+
+        for (iptables, iptables_restore) in self.iptables_commands:
+            for args in (['-D', 'OUTPUT', '-j', MANGLE_CHAIN],
+                         ['-F', MANGLE_CHAIN],
+                         ['-X', MANGLE_CHAIN]):
+                subprocess.call([iptables, '-t', 'mangle'] + args,
+                                stderr=subprocess.DEVNULL)
+        self.chain_ready = False
+
+    def _replace_rules(self, rules):
+        """
+        Replaces the rules in the PATHSPIDER chain atomically, with one run of
+        iptables-restore for each address family. Other rules in the mangle
+        table are left alone.
+        """
+
+        if not self.chain_ready:
+            self._setup_chain()
+
+        for (iptables, iptables_restore) in self.iptables_commands:
+            subprocess.run([iptables_restore, '--noflush'],
+                           input=rules, check=True)
+
     def config_zero(self):
         """
         Disables DSCP marking via iptables.
         """
 
         logger = logging.getLogger('dscpsider')
-        for iptables in ['iptables', 'ip6tables']:
-            subprocess.check_call([iptables, '-t', 'mangle', '-F'])
+        self._replace_rules(RULES_ZERO)
         logger.debug("Configurator disabled DSCP marking")
 
     def config_one(self):
@@ -72,13 +144,42 @@ class DSCPSpider(Spider):
         """
 
         logger = logging.getLogger('dscpsider')
-        for iptables in ['iptables', 'ip6tables']:
-            subprocess.check_call([iptables, '-t', 'mangle', '-A', 'OUTPUT',
-                '-p', 'tcp', '-m', 'tcp', '--dport', '80', '-j', 'DSCP',
-                '--set-dscp-class', 'ef'])
+        self._replace_rules(RULES_ONE)
         logger.debug("Configurator enabled DSCP marking")
 
+    def start(self):
+        """
+        Empties the PATHSPIDER chain before starting, so that no rules left
+        by an earlier run stay active. In barrier-free mode the configurator
+        never replaces them.
+        """
+
+        self._setup_chain()
+        super().start()
+
+    def shutdown(self):
+        super().shutdown()
+        self._remove_chain()
+
+    def terminate(self):
+        super().terminate()
+        self._remove_chain()
+
+    def configure_socket(self, sock, config):
+        """
+        Marks packets of the socket with DSCP class EF for the experimental
+        connection, as config_one does with iptables. Like the iptables
+        rule, connect only applies this to connections to MARKED_PORT.
+        """
+
+        tos = TOS_EF if config == 1 else 0
+        if sock.family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_TCLASS, tos)
+        else:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, tos)
+
     def _connect(self, sock, job):
+        # None if the connection must be made again from another port
         try:
             sock.settimeout(self.conn_timeout)
             sock.connect((job[0], job[1]))
@@ -86,7 +187,21 @@ class DSCPSpider(Spider):
             return Connection(sock, sock.getsockname()[1], CONN_OK)
         except TimeoutError:
             return Connection(sock, sock.getsockname()[1], CONN_TIMEOUT)
-        except OSError:
+        except OSError as e:
+            if self.source_port_clash(sock, e):
+                return None
+            return Connection(sock, sock.getsockname()[1], CONN_FAILED)
+
+    async def _connect_async(self, sock, job):
+        try:
+            await sock_connect(sock, (job[0], job[1]), self.conn_timeout)
+
+            return Connection(sock, sock.getsockname()[1], CONN_OK)
+        except TimeoutError:
+            return Connection(sock, sock.getsockname()[1], CONN_TIMEOUT)
+        except OSError as e:
+            if self.source_port_clash(sock, e):
+                return None
             return Connection(sock, sock.getsockname()[1], CONN_FAILED)
 
     def connect(self, job, pcs, config):
@@ -98,6 +213,10 @@ class DSCPSpider(Spider):
             sock = socket.socket(socket.AF_INET6)
         else:
             sock = socket.socket(socket.AF_INET)
+        self.bind_source(sock, job)
+
+        if self.barrier_free and job[1] == MARKED_PORT:
+            self.configure_socket(sock, config)
 
         conn = self._connect(sock, job)
 
@@ -107,6 +226,34 @@ class DSCPSpider(Spider):
         except:
             pass
 
+        if conn is None:
+            return self.connect(job, pcs, config)
+        return conn
+
+    async def connect_async(self, job, pcs, config):
+        """
+        Performs a TCP connection without blocking the event loop.
+        """
+
+        if ":" in job[0]:
+            sock = socket.socket(socket.AF_INET6)
+        else:
+            sock = socket.socket(socket.AF_INET)
+        self.bind_source(sock, job)
+
+        if self.barrier_free and job[1] == MARKED_PORT:
+            self.configure_socket(sock, config)
+
+        conn = await self._connect_async(sock, job)
+
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+        except:
+            pass
+
+        if conn is None:
+            return await self.connect_async(job, pcs, config)
         return conn
 
 
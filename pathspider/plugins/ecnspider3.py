@@ -10,17 +10,23 @@ import collections
 
 from pathspider.base import Spider
 from pathspider.base import NO_FLOW
+from pathspider.base import MERGE_TTL
+from pathspider.base import MERGE_CAP
+from pathspider.base import ExpiringTable
+from pathspider.base import sock_connect
 
 from pathspider.observer import Observer
 from pathspider.observer import basic_flow
 from pathspider.observer import basic_count
+from pathspider.observer import flow_fields
 from pathspider.observer.tcp import tcp_setup
 from pathspider.observer.tcp import tcp_complete
 
 Connection = collections.namedtuple("Connection", ["client", "port", "state", "tstart"])
 SpiderRecord = collections.namedtuple("SpiderRecord", ["ip", "rport", "port",
                                                        "rank", "host", "ecnstate",
-                                                       "connstate", "tstart", "tstop"])
+                                                       "connstate", "tstart", "tstop",
+                                                       "jobid"])
 
 CONN_OK = 0
 CONN_FAILED = 1
@@ -28,6 +34,13 @@ CONN_TIMEOUT = 2
 
 USER_AGENT = "pathspider"
 
+TCP_ECN_PATH = "/proc/sys/net/ipv4/tcp_ecn"
+
+# How long a flow waits for the flow of the same job in the other
+# configuration: each of them may have waited MERGE_TTL for its result
+PAIR_TTL = 2 * MERGE_TTL
+PAIR_CAP = MERGE_CAP
+
 TCP_CWR = 0x80
 TCP_ECE = 0x40
 TCP_ACK = 0x10
@@ -38,12 +51,14 @@ TCP_SAE = (TCP_SYN | TCP_ACK | TCP_ECE)
 
 ## Chain functions
 
+@flow_fields('ecn_zero', 'ecn_one', 'ce')
 def ecnsetup(rec, ip):
     rec['ecn_zero'] = False
     rec['ecn_one'] = False
     rec['ce'] = False
     return True
 
+@flow_fields('fwd_syn_flags', 'rev_syn_flags')
 def ecnflags(rec, tcp, rev):
     flags = tcp.flags
 
@@ -73,12 +88,76 @@ def ecncode(rec, ip, rev):
 
 class ECNSpider(Spider):
 
+    binds_source_ports = True
+
+    # Each of the flow results repeats the addresses, port, host and rank
+    # of the whole result, and the protocol is always TCP
+    result_schema = ('sip', 'dip', 'dp', 'conditions', 'hostname', 'rank',
+                     ('flow_results', ('sp', 'observed', 'connstate',
+                                       'ecnstate', 'first', 'last',
+                                       'pkt_fwd', 'pkt_rev',
+                                       'oct_fwd', 'oct_rev',
+                                       'fwd_fin', 'fwd_rst',
+                                       'rev_fin', 'rev_rst',
+                                       'fwd_syn_flags', 'rev_syn_flags',
+                                       'ecn_zero', 'ecn_one', 'ce',
+                                       'tstart', 'tstop')),
+                     'time')
+
     def __init__(self, worker_count, libtrace_uri):
         super().__init__(worker_count=worker_count,
                          libtrace_uri=libtrace_uri)
         self.tos = None # set by configurator
         self.conn_timeout = 10
-        self.comparetab = {}
+
+        # flows waiting for the flow of the same job in the other
+        # configuration, keyed by (job id, configuration), or by
+        # ((address, port), configuration) for jobs without an id
+        self.comparetab = ExpiringTable(PAIR_TTL, PAIR_CAP)
+        self.ct_paired = 0
+        self.ct_unpaired = 0
+        self.comparetab_peak = 0
+
+        # the open tcp_ecn sysctl file, or False to use sysctl instead
+        self.tcp_ecn_path = TCP_ECN_PATH
+        self.tcp_ecn_file = None
+
+    def _set_tcp_ecn(self, value):
+        """
+        Set the net.ipv4.tcp_ecn sysctl by writing to its file in /proc,
+        keeping the file open between calls, and check that the value was
+        set by reading it back. If the file cannot be used, fall back to
+        running sysctl, and keep doing so.
+        """
+
+        logger = logging.getLogger('ecnspider3')
+        value = str(value).encode()
+
+        if self.tcp_ecn_file is not False:
+            try:
+                if self.tcp_ecn_file is None:
+                    self.tcp_ecn_file = open(self.tcp_ecn_path, 'r+b',
+                                             buffering=0)
+                self.tcp_ecn_file.seek(0)
+                self.tcp_ecn_file.write(value + b"\n")
+                self.tcp_ecn_file.seek(0)
+                readback = self.tcp_ecn_file.read().strip()
+                if readback == value:
+                    return
+                logger.warning("%s reads back %r after writing %r, "
+                               "falling back to sysctl", self.tcp_ecn_path,
+                               readback, value)
+            except OSError as e:
+                logger.warning("cannot write %s (%s), falling back to sysctl",
+                               self.tcp_ecn_path, e)
+
+            if self.tcp_ecn_file:
+                self.tcp_ecn_file.close()
+            self.tcp_ecn_file = False
+
+        subprocess.check_call(['/sbin/sysctl', '-w',
+                               'net.ipv4.tcp_ecn=' + value.decode()],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     def config_zero(self):
         """
@@ -86,8 +165,7 @@ class ECNSpider(Spider):
         """
 
         logger = logging.getLogger('ecnspider3')
-        subprocess.check_call(['/sbin/sysctl', '-w', 'net.ipv4.tcp_ecn=2'],
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._set_tcp_ecn(2)
         logger.debug("Configurator disabled ECN")
 
     def config_one(self):
@@ -96,8 +174,7 @@ class ECNSpider(Spider):
         """
 
         logger = logging.getLogger('ecnspider3')
-        subprocess.check_call(['/sbin/sysctl', '-w', 'net.ipv4.tcp_ecn=1'],
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._set_tcp_ecn(1)
         logger.debug("Configurator enabled ECN")
 
     def connect(self, job, pcs, config):
@@ -113,6 +190,7 @@ class ECNSpider(Spider):
             sock = socket.socket(socket.AF_INET6)
         else:
             sock = socket.socket(socket.AF_INET)
+        self.bind_source(sock, job)
 
         try:
             sock.settimeout(self.conn_timeout)
@@ -121,7 +199,37 @@ class ECNSpider(Spider):
             return Connection(sock, sock.getsockname()[1], CONN_OK, tstart)
         except TimeoutError:
             return Connection(sock, sock.getsockname()[1], CONN_TIMEOUT, tstart)
-        except OSError:
+        except OSError as e:
+            if self.source_port_clash(sock, e):
+                sock.close()
+                return self.connect(job, pcs, config)
+            return Connection(sock, sock.getsockname()[1], CONN_FAILED, tstart)
+
+    async def connect_async(self, job, pcs, config):
+        """
+        Performs a TCP connection without blocking the event loop.
+        """
+
+        job_ip, job_port, job_host, job_rank = job
+
+        tstart = str(datetime.utcnow())
+
+        if ":" in job_ip:
+            sock = socket.socket(socket.AF_INET6)
+        else:
+            sock = socket.socket(socket.AF_INET)
+        self.bind_source(sock, job)
+
+        try:
+            await sock_connect(sock, (job_ip, job_port), self.conn_timeout)
+
+            return Connection(sock, sock.getsockname()[1], CONN_OK, tstart)
+        except TimeoutError:
+            return Connection(sock, sock.getsockname()[1], CONN_TIMEOUT, tstart)
+        except OSError as e:
+            if self.source_port_clash(sock, e):
+                sock.close()
+                return await self.connect_async(job, pcs, config)
             return Connection(sock, sock.getsockname()[1], CONN_FAILED, tstart)
 
     def post_connect(self, job, conn, pcs, config):
@@ -132,11 +240,12 @@ class ECNSpider(Spider):
         job_ip, job_port, job_host, job_rank = job
 
         tstop = str(datetime.utcnow())
+        jobid = getattr(job, 'jobid', None)
 
         if conn.state == CONN_OK:
-            rec = SpiderRecord(job_ip, job_port, conn.port, job_rank, job_host, config, True, conn.tstart, tstop)
+            rec = SpiderRecord(job_ip, job_port, conn.port, job_rank, job_host, config, True, conn.tstart, tstop, jobid)
         else:
-            rec = SpiderRecord(job_ip, job_port, conn.port, job_rank, job_host, config, False, conn.tstart, tstop)
+            rec = SpiderRecord(job_ip, job_port, conn.port, job_rank, job_host, config, False, conn.tstart, tstop, jobid)
 
         try:
             conn.client.shutdown(socket.SHUT_RDWR)
@@ -168,52 +277,109 @@ class ECNSpider(Spider):
             traceback.print_exc()
             sys.exit(-1)
 
-    def combine_flows(self, flow):
-        dip = flow['dip']
-        if dip in self.comparetab:
-            other_flow = self.comparetab.pop(dip)
+    def combine_flows(self, flow, jobid):
+        """
+        Pair the flows of a job in the two configurations, and emit a
+        record comparing them once both have been merged. Jobs without a
+        number are paired by their address and port instead; the source
+        port differs between the two connections of a job.
+        """
+
+        if jobid is None:
+            jobid = (flow['dip'], flow['dp'])
+        config = flow['ecnstate']
+        if (jobid, 1 - config) not in self.comparetab:
+            self.comparetab[(jobid, config)] = flow
+            self.comparetab_peak = max(self.comparetab_peak,
+                                       len(self.comparetab))
+            return
+
+        other_flow = self.comparetab.pop((jobid, 1 - config))
+        self.ct_paired += 1
+
+        # first has always ecn off, while the second has ecn on
+        flows = (flow, other_flow) if other_flow['ecnstate'] else (other_flow, flow)
+
+        # discard non-observed flows and flows with no syn observed
+        for f in flows:
+            if not (f['observed'] and "rev_syn_flags" in f.keys()):
+                return
+
+        tstart = min(flow['tstart'], other_flow['tstart'])
+        tstop = max(flow['tstop'], other_flow['tstop'])
+
+        if flows[0]['connstate'] and flows[1]['connstate']:
+            cond_conn = 'ecn.connectivity.works'
+        elif flows[0]['connstate'] and not flows[1]['connstate']:
+            cond_conn = 'ecn.connectivity.broken'
+        elif not flows[0]['connstate'] and not flows[1]['connstate']:
+            cond_conn = 'ecn.connectivity.transient'
+        else:
+            cond_conn = 'ecn.connectivity.offline'
 
-            # first has always ecn off, while the second has ecn on
-            flows = (flow, other_flow) if other_flow['ecnstate'] else (other_flow, flow)
+        # FIXME: I need to be convinced this is a complete test
+        if flows[1]['rev_syn_flags'] & TCP_SAEW == TCP_SAE:
+            cond_nego = 'ecn.negotiated'
+        else:
+            cond_nego = 'ecn.not_negotiated'
+
+        self.outqueue.put({
+            'sip': flow['sip'],
+            'dip': flow['dip'],
+            'dp': flow['dp'],
+            'conditions': [cond_conn, cond_nego],
+            'hostname': flow['host'],
+            'rank': flow['rank'],
+            'flow_results': flows,
+            'time': {
+                'from': tstart,
+                'to': tstop
+            }
+        })
+
+    def emit_unpaired(self, flow):
+        """
+        Emit a record for a flow whose flow in the other configuration
+        never arrived, so that connectivity cannot be compared.
+        """
 
-            # discard non-observed flows and flows with no syn observed
-            for f in flows:
-                if not (f['observed'] and "rev_syn_flags" in f.keys()):
-                    return
+        self.ct_unpaired += 1
+        self.outqueue.put({
+            'sip': flow.get('sip'),
+            'dip': flow['dip'],
+            'dp': flow['dp'],
+            'conditions': ['ecn.connectivity.unknown'],
+            'hostname': flow['host'],
+            'rank': flow['rank'],
+            'flow_results': (flow,),
+            'time': {
+                'from': flow['tstart'],
+                'to': flow['tstop']
+            }
+        })
+
+    def flush_merged(self, final=False):
+        """
+        Emit the flows which have waited too long to be paired, or at the
+        end, all of those still waiting.
+        """
+
+        logger = logging.getLogger('ecnspider3')
 
-            tstart = min(flow['tstart'], other_flow['tstart'])
-            tstop = max(flow['tstop'], other_flow['tstop'])
-
-            if flows[0]['connstate'] and flows[1]['connstate']:
-                cond_conn = 'ecn.connectivity.works'
-            elif flows[0]['connstate'] and not flows[1]['connstate']:
-                cond_conn = 'ecn.connectivity.broken'
-            elif not flows[0]['connstate'] and not flows[1]['connstate']:
-                cond_conn = 'ecn.connectivity.transient'
-            else:
-                cond_conn = 'ecn.connectivity.offline'
-
-            # FIXME: I need to be convinced this is a complete test
-            if flows[1]['rev_syn_flags'] & TCP_SAEW == TCP_SAE:
-                cond_nego = 'ecn.negotiated'
-            else:
-                cond_nego = 'ecn.not_negotiated'
-
-            self.outqueue.put({
-                'sip': flow['sip'],
-                'dip': dip,
-                'dp': flow['dp'],
-                'conditions': [cond_conn, cond_nego],
-                'hostname': flow['host'],
-                'rank': flow['rank'],
-                'flow_results': flows,
-                'time': {
-                    'from': tstart,
-                    'to': tstop
-                }
-            })
+        if final:
+            flows = self.comparetab.drain()
         else:
-            self.comparetab[dip] = flow
+            flows = self.comparetab.expire()
+        for flow in flows:
+            self.emit_unpaired(flow)
+
+        if final:
+            logger.info(("paired the flows of %u jobs, %u flows unpaired "
+                         "(%u expired, %u evicted over capacity), "
+                         "at most %u waiting at once") %
+                        (self.ct_paired, self.ct_unpaired,
+                         self.comparetab.ct_expired,
+                         self.comparetab.ct_evicted, self.comparetab_peak))
 
     def merge(self, flow, res):
         """
@@ -240,5 +406,5 @@ class ECNSpider(Spider):
         flow['tstop'] = res.tstop
 
         logger.debug("Result: " + str(flow))
-        self.combine_flows(flow)
+        self.combine_flows(flow, res.jobid)
 
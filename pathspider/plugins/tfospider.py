@@ -1,7 +1,6 @@
 
 import sys
 import logging
-import subprocess
 import traceback
 
 import socket
@@ -9,10 +8,12 @@ import collections
 
 from pathspider.base import Spider
 from pathspider.base import NO_FLOW
+from pathspider.base import sock_connect
 
 from pathspider.observer import Observer
 from pathspider.observer import basic_flow
 from pathspider.observer import basic_count
+from pathspider.observer import flow_fields
 
 Connection = collections.namedtuple("Connection", ["client", "port", "state"])
 SpiderRecord = collections.namedtuple("SpiderRecord", ["ip", "rport", "port",
@@ -30,6 +31,7 @@ USER_AGENT = "pathspider"
 def tcpcompleted(rec, tcp, rev): # pylint: disable=W0612,W0613
     return not tcp.fin_flag
 
+@flow_fields('tfo_seq', 'tfo_len', 'tfoworking')
 def tfosetup(rec, ip):
     rec['tfo_seq'] = -1000
     rec['tfo_len'] = -1000
@@ -143,6 +145,11 @@ def test_tfocookie(fn=_tfocookie):
 
 class TFOSpider(Spider):
 
+    per_socket_config = True
+    # the cookie request connection is not bound, but its flow is not
+    # merged with a result either
+    binds_source_ports = True
+
     def __init__(self, worker_count, libtrace_uri, check_interrupt=None):
         super().__init__(worker_count=worker_count,
                          libtrace_uri=libtrace_uri)
@@ -154,6 +161,13 @@ class TFOSpider(Spider):
 
     def config_one(self):
         pass
+
+    def configure_socket(self, sock, config):
+        """
+        TFO is requested for each connection by the way it is made, so
+        there is nothing to configure.
+        """
+        pass
         
     def connect(self, job, pcs, config):
         # determine ip version
@@ -165,6 +179,7 @@ class TFOSpider(Spider):
         # regular TCP
         if config == 0:
             sock = socket.socket(af, socket.SOCK_STREAM)
+            self.bind_source(sock, job)
 
             try:
                 sock.settimeout(self.conn_timeout)
@@ -173,7 +188,10 @@ class TFOSpider(Spider):
                 return Connection(sock, sock.getsockname()[1], CONN_OK)             
             except TimeoutError:
                 return Connection(sock, sock.getsockname()[1], CONN_TIMEOUT)
-            except OSError:
+            except OSError as e:
+                if self.source_port_clash(sock, e):
+                    sock.close()
+                    return self.connect(job, pcs, config)
                 return Connection(sock, sock.getsockname()[1], CONN_FAILED)    
         
         # with TFO
@@ -188,16 +206,53 @@ class TFOSpider(Spider):
             except:
                 pass
             
-            # step two: use cookie
-            try:
-                sock = socket.socket(af, socket.SOCK_STREAM)
-                sock.sendto(message, socket.MSG_FASTOPEN, (job[0], job[1]))
-                
-                return Connection(sock, sock.getsockname()[1], CONN_OK)
-            except TimeoutError:
-                return Connection(sock, sock.getsockname()[1], CONN_TIMEOUT)
-            except OSError:
-                return Connection(sock, sock.getsockname()[1], CONN_FAILED)  
+            # step two: use cookie, from another source port if the one
+            # bound is still in TIME_WAIT
+            while True:
+                try:
+                    sock = socket.socket(af, socket.SOCK_STREAM)
+                    self.bind_source(sock, job)
+                    sock.sendto(message, socket.MSG_FASTOPEN, (job[0], job[1]))
+
+                    return Connection(sock, sock.getsockname()[1], CONN_OK)
+                except TimeoutError:
+                    return Connection(sock, sock.getsockname()[1], CONN_TIMEOUT)
+                except OSError as e:
+                    if self.source_port_clash(sock, e):
+                        sock.close()
+                        continue
+                    return Connection(sock, sock.getsockname()[1], CONN_FAILED)
+
+    async def connect_async(self, job, pcs, config):
+        """
+        Performs the connection without blocking the event loop. The TFO
+        connection sends its data with the SYN from sendto(), which has no
+        non-blocking equivalent in asyncio, so it is run in a thread pool.
+        """
+        if config == 1:
+            return await super().connect_async(job, pcs, config)
+
+        # determine ip version
+        if job[0].count(':') >= 1: 
+            af = socket.AF_INET6
+        else: 
+            af = socket.AF_INET
+
+        # regular TCP
+        sock = socket.socket(af, socket.SOCK_STREAM)
+        self.bind_source(sock, job)
+
+        try:
+            await sock_connect(sock, (job[0], job[1]), self.conn_timeout)
+
+            return Connection(sock, sock.getsockname()[1], CONN_OK)
+        except TimeoutError:
+            return Connection(sock, sock.getsockname()[1], CONN_TIMEOUT)
+        except OSError as e:
+            if self.source_port_clash(sock, e):
+                sock.close()
+                return await self.connect_async(job, pcs, config)
+            return Connection(sock, sock.getsockname()[1], CONN_FAILED)
 
     def post_connect(self, job, conn, pcs, config):
         if conn.state == CONN_OK:
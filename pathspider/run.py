@@ -1,15 +1,21 @@
 
 import argparse
-import csv
 import logging
 import time
 import threading
-import json
 
 from straight.plugin import load
 
 from pathspider.base import Spider
 from pathspider.base import SHUTDOWN_SENTINEL
+from pathspider.base import Checkpoint
+from pathspider.feeder import job_feeder
+from pathspider.feeder import read_checkpoint
+from pathspider.feeder import write_checkpoint
+from pathspider.sinks import SINKS
+from pathspider.sinks import open_sink
+from pathspider.sinks import ResultEncoder
+from pathspider.replay import run_observe
 
 import sys
 
@@ -17,21 +23,11 @@ plugins = load("pathspider.plugins", subclasses=Spider)
 
 print(repr(list(plugins)))
 
-def job_feeder(inputfile, spider):
-    with open(inputfile) as fp:
-        print("job_feeder: started")
-        reader = csv.reader(fp, delimiter=',', quotechar='"')
-        for row in reader:
-            # port numbers should be integers
-            row[1] = int(row[1])
-
-            spider.add_job(row)
-        
-        print("job_feeder: all jobs added, waiting for spider to finish")
-        spider.shutdown()
-        print("job_feeder: stopped")
-
 def run_pathspider():
+    # pathspider observe --replay FILE runs an observer offline
+    if len(sys.argv) > 1 and sys.argv[1] == 'observe':
+        sys.exit(run_observe(plugins, sys.argv[2:]))
+
     parser = argparse.ArgumentParser(description='''Pathspider will spider the
             paths.''')
     parser.add_argument('-s', '--standalone', action='store_true', help='''run in
@@ -42,11 +38,52 @@ def run_pathspider():
     parser.add_argument('-p', '--plugin', help='''use named plugin''')
     parser.add_argument('-i', '--interface', help='''the interface to use for the observer''')
     parser.add_argument('-w', '--worker-count', type=int, help='''number of workers to use''')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'],
+            default='threads', help='''run workers as threads, or as
+            coroutines on one event loop (for many thousands of workers)''')
+    parser.add_argument('--barrier-free', action='store_true', help='''configure
+            each connection's socket rather than the system, so workers do not
+            wait for each other (only for plugins which support it)''')
+    parser.add_argument('--worker-groups', type=int, default=1, help='''number
+            of processes to divide the workers between''')
+    parser.add_argument('--job-batch', type=int, default=1, help='''number
+            of jobs each worker runs per configuration change''')
+    parser.add_argument('--source-ports', type=int, metavar='BASEPORT',
+            help='''give each worker its own range of source ports from this
+            port, so the observer can ignore other traffic''')
+    parser.add_argument('--source-ports-per-worker', type=int, default=64,
+            help='''number of source ports each worker cycles through''')
+    parser.add_argument('--observer-count', type=int, default=1, help='''number
+            of observer processes to split flows between''')
+    parser.add_argument('--compact-flow-records', action='store_true',
+            help='''store observer flow records in less memory, at some cost
+            in CPU time per packet (for very many concurrent flows)''')
+    parser.add_argument('--metrics-file', metavar='METRICSFILE', help='''write
+            configurator metrics to this file periodically''')
+    parser.add_argument('--metrics-format', choices=['jsonl', 'prometheus'],
+            default='jsonl', help='''append metrics as JSON lines, or replace the
+            file with metrics in the Prometheus text format''')
+    parser.add_argument('--metrics-interval', type=float, default=10,
+            help='''seconds between metrics exports''')
+    parser.add_argument('--profile-observer', action='store_true', help='''log
+            the time spent in each observer function at shutdown''')
     parser.add_argument('-I', '--input-file', metavar='INPUTFILE', help='''a file
             containing a list of remote hosts to test, with any accompanying
             metadata expected by the pathspider test. this file should be formatted
             as a comma-seperated values file.''')
     parser.add_argument('-o', '--output-file', metavar='OUTPUTFILE', help='''the file to output results data to''')
+    parser.add_argument('--output-format', choices=sorted(SINKS),
+            help='''how to write the results: JSON lines, compressed JSON
+            lines, or CSV with a column per field. by default this is chosen
+            from the output file name''')
+    parser.add_argument('--checkpoint-file', metavar='CHECKPOINTFILE',
+            help='''record how many input rows have all their results
+            written to this file, to resume from''')
+    parser.add_argument('--checkpoint-interval', type=float, default=10,
+            help='''seconds between checkpoints''')
+    parser.add_argument('--resume', action='store_true', help='''skip the
+            input rows recorded in the checkpoint file, and append to the
+            output file''')
 
     args = parser.parse_args()
 
@@ -75,22 +112,57 @@ def run_pathspider():
             logger.error("Plugin not found! Cannot continue.")
             logger.error("Use -l to list all plugins.")
             sys.exit(1)
+
+        spider.engine = args.engine
+        spider.barrier_free = args.barrier_free
+        spider.job_batch_size = args.job_batch
+        spider.worker_group_count = args.worker_groups
+        spider.source_port_base = args.source_ports
+        spider.source_ports_per_worker = args.source_ports_per_worker
+        spider.observer_count = args.observer_count
+        spider.observer_profile = args.profile_observer
+        spider.observer_compact_records = args.compact_flow_records
+        spider.metrics_file = args.metrics_file
+        spider.metrics_format = args.metrics_format
+        spider.metrics_interval = args.metrics_interval
+
+        start = 0
+        if args.checkpoint_file is not None:
+            spider.checkpoint_interval = args.checkpoint_interval
+            if args.resume:
+                start = read_checkpoint(args.checkpoint_file, args.input_file)
+                logger.info("resuming from row %u", start)
         
         print("activating spider...")
         
         spider.start()
 
         print("starting to add jobs")
-        threading.Thread(target=job_feeder, args=(args.input_file, spider)).start()
+        threading.Thread(target=job_feeder,
+                         args=(args.input_file, spider, start)).start()
         
-        with open(args.output_file, 'w') as outputfile:
+        encoder = ResultEncoder(spider.result_schema)
+        with open_sink(args.output_file, args.output_format,
+                       append=args.resume, encoder=encoder) as sink:
             while True:
                 result = spider.outqueue.get()
                 if result == SHUTDOWN_SENTINEL:
                     break
-                outputfile.write(json.dumps(result) + "\n")
+                if isinstance(result, Checkpoint):
+                    # the results before the checkpoint must be on disk
+                    # before it is recorded
+                    sink.sync()
+                    write_checkpoint(args.checkpoint_file, args.input_file,
+                                     result.jobs)
+                else:
+                    sink.write(result)
                 spider.outqueue.task_done()
 
+        if spider.exception is not None:
+            logger.error("spider terminated after an error: " +
+                         repr(spider.exception))
+            sys.exit(1)
+
     except KeyboardInterrupt:
         print("kthxbye")
 
@@ -0,0 +1,310 @@
+"""
+Result sinks, writing the merged results of a spider to a file.
+
+Each sink collects records into batches of ``batch_size`` and writes a whole
+batch at once, rather than making a write call for each record:
+
+ * ``jsonl``: one JSON object per line
+ * ``jsonl.gz``, ``jsonl.zst``: the same, compressed with gzip or (with the
+   optional zstandard module) zstd as it is written
+ * ``csv``: one row per record and one column per field, with nested
+   objects flattened into columns named by their path, such as
+   ``time.from``; lists are written as JSON. The columns are those of the
+   first batch written, or when appending to a file, those of its header,
+   and any fields seen later which are not among them are written as a
+   JSON object in the ``extra`` column.
+
+:func:`open_sink` chooses the sink from the file name unless the format is
+given. :meth:`ResultSink.sync` writes out everything written so far and
+flushes it to disk, so that a checkpoint can be recorded after it.
+
+Records are passed through a :class:`ResultEncoder` built from the plugin's
+``result_schema``, which keeps only the fields the schema names and encodes
+JSON with orjson when it is installed.
+
+"""
+
+import io
+import os
+import csv
+import gzip
+import json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SINK_BATCH_SIZE = 1000
+
+def _projector(schema):
+    """
+    Build a function returning a copy of a record with only the fields named
+    by a schema. Applied to a list or tuple, it returns a list of the
+    projections of its elements. The record itself is left unchanged.
+
+    The fields of a plugin's records are much the same from one record to
+    the next, so rather than look up each field to keep, the projection
+    copies the record in one step and removes the fields which earlier
+    records had outside the schema. Only when a record has a field not seen
+    before does it work out which fields to remove.
+    """
+    names = frozenset(spec if isinstance(spec, str) else spec[0]
+                      for spec in schema)
+    nested = [(spec[0], _projector(spec[1]))
+              for spec in schema if not isinstance(spec, str)]
+    extra = []
+
+    def project_dict(value):
+        projected = value.copy()
+        for name in extra:
+            projected.pop(name, None)
+        if not projected.keys() <= names:
+            unseen = projected.keys() - names
+            extra.extend(unseen)
+            for name in unseen:
+                del projected[name]
+        for (name, subproject) in nested:
+            if name in projected:
+                projected[name] = subproject(projected[name])
+        return projected
+
+    def project(value):
+        if isinstance(value, dict):
+            return project_dict(value)
+        if isinstance(value, (list, tuple)):
+            return [project_dict(element) if isinstance(element, dict)
+                    else element for element in value]
+        return value
+
+    return project
+
+class ResultEncoder:
+    """
+    Encodes result records as JSON, keeping only the fields named by a
+    schema.
+
+    A schema is a set of field names. In place of a name, a
+    ``(name, schema)`` pair applies another schema to the field's value,
+    which is either a dict or a list or tuple of dicts. Records are encoded
+    from a projection keeping only those fields, and are not changed
+    themselves. With no schema, records are encoded whole.
+
+    :param accelerated: Use orjson if it is installed.
+    """
+    def __init__(self, schema=None, accelerated=True):
+        self.schema = schema
+        self.project = None if schema is None else _projector(schema)
+        self.accelerated = accelerated and orjson is not None
+        self._dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+    def encode_lines(self, records):
+        """
+        Encode records as JSON lines.
+
+        :returns: bytes -- One line for each record.
+        """
+        if self.project is not None:
+            records = [self.project(record) for record in records]
+        if self.accelerated:
+            dumps = orjson.dumps
+            option = orjson.OPT_APPEND_NEWLINE
+            return b"".join([dumps(record, option=option)
+                             for record in records])
+        dumps = self._dumps
+        return "".join([dumps(record) + "\n"
+                        for record in records]).encode("utf-8")
+
+class ResultSink:
+    """
+    Base class for result sinks. Subclasses implement :meth:`_write_batch`
+    and may override :meth:`_open` and :meth:`_flush`.
+    """
+    def __init__(self, path, append=False, batch_size=SINK_BATCH_SIZE,
+                 encoder=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.encoder = ResultEncoder() if encoder is None else encoder
+        self.records = 0
+        self._batch = []
+        self._raw = open(path, "ab" if append else "wb")
+        self._fp = self._open(self._raw)
+
+    def _open(self, raw):
+        return raw
+
+    def write(self, record):
+        self._batch.append(record)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write out the records collected so far.
+        """
+        if self._batch:
+            self._write_batch(self._batch)
+            self.records += len(self._batch)
+            self._batch = []
+
+    def _write_batch(self, records):
+        raise NotImplementedError("Cannot write to an abstract sink")
+
+    def _flush(self):
+        self._fp.flush()
+
+    def sync(self):
+        """
+        Write out the records collected so far and flush them to disk.
+        """
+        self.flush()
+        self._flush()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+
+    def close(self):
+        self.flush()
+        self._fp.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class JSONLSink(ResultSink):
+    """
+    Writes one JSON object per line.
+    """
+    def _write_batch(self, records):
+        self._fp.write(self.encoder.encode_lines(records))
+
+class GzipJSONLSink(JSONLSink):
+    """
+    Writes one JSON object per line, compressed with gzip. Appending adds a
+    gzip member, which gzip reads as part of the same stream.
+    """
+    def _open(self, raw):
+        return gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6)
+
+class ZstdJSONLSink(JSONLSink):
+    """
+    Writes one JSON object per line, compressed with zstd. Appending adds a
+    zstd frame.
+    """
+    def _open(self, raw):
+        if zstandard is None:
+            raise ValueError("writing " + self.path + " needs the zstandard "
+                             "module")
+        return zstandard.ZstdCompressor(level=3).stream_writer(raw)
+
+    def _flush(self):
+        self._fp.flush(zstandard.FLUSH_BLOCK)
+
+def _flatten(record, prefix="", into=None):
+    """
+    Flatten nested dictionaries into one, with keys joined by dots.
+    """
+    flat = {} if into is None else into
+    for (key, value) in record.items():
+        key = prefix + str(key)
+        if isinstance(value, dict):
+            _flatten(value, key + ".", flat)
+        else:
+            flat[key] = value
+    return flat
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        return json.dumps(value)
+    return value
+
+class CSVSink(ResultSink):
+    """
+    Writes records as CSV rows, one column per field. See the module
+    description for how the columns are chosen.
+    """
+    def __init__(self, path, append=False, batch_size=SINK_BATCH_SIZE,
+                 encoder=None):
+        # only write a header to a new or empty file; when appending to a
+        # file with a header, keep its columns
+        self._header = not append or not os.path.exists(path) or \
+                       os.path.getsize(path) == 0
+        self._columns = None
+        if not self._header:
+            with open(path, encoding="utf-8", newline="") as fp:
+                self._columns = next(csv.reader(fp), None)
+        super().__init__(path, append, batch_size, encoder)
+        self._writer = csv.writer(self._fp)
+
+    def _open(self, raw):
+        return io.TextIOWrapper(raw, encoding="utf-8", newline="",
+                                write_through=True)
+
+    def _write_batch(self, records):
+        project = self.encoder.project
+        if project is not None:
+            records = [project(record) for record in records]
+        flat = [_flatten(record) for record in records]
+
+        if self._columns is None:
+            columns = {}
+            for row in flat:
+                columns.update(dict.fromkeys(row))
+            self._columns = list(columns) + ["extra"]
+            if self._header:
+                self._writer.writerow(self._columns)
+        known = self._columns[:-1]
+
+        rows = []
+        for row in flat:
+            values = [_csv_value(row.pop(column, None)) for column in known]
+            values.append(json.dumps(row) if row else "")
+            rows.append(values)
+        self._writer.writerows(rows)
+
+SINKS = {
+    "jsonl": JSONLSink,
+    "jsonl.gz": GzipJSONLSink,
+    "jsonl.zst": ZstdJSONLSink,
+    "csv": CSVSink,
+}
+
+def sink_format(path):
+    """
+    Guess the sink format for a file name.
+    """
+    if path.endswith(".gz"):
+        return "jsonl.gz"
+    if path.endswith((".zst", ".zstd")):
+        return "jsonl.zst"
+    if path.endswith(".csv"):
+        return "csv"
+    return "jsonl"
+
+def open_sink(path, format=None, append=False, batch_size=SINK_BATCH_SIZE,
+              encoder=None):
+    """
+    Open a result sink.
+
+    :param path: The file to write to.
+    :param format: One of the keys of :data:`SINKS`, or None to choose from
+                   the file name.
+    :param append: Append to the file rather than replacing it.
+    :param encoder: The :class:`ResultEncoder` to use, by default one
+                    encoding records whole.
+    :returns: ResultSink -- The sink.
+    """
+    if format is None:
+        format = sink_format(path)
+    if format not in SINKS:
+        raise ValueError("unknown output format " + repr(format))
+    return SINKS[format](path, append, batch_size, encoder)